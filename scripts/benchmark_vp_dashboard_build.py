@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import csv
+import datetime as dt
+import gzip
+import html
+import importlib.util
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+BUILD_SCRIPT = ROOT / "scripts" / "build_vp_dashboard_data.py"
+
+# Source headers in export order. "BOM" precedes "Rent $ (BOM)" as in the real export:
+# pick() matches by substring, so this order is what makes the bom column resolve.
+HEADERS = [
+    "Loannumber",
+    "LoanAmount",
+    "VP",
+    "BOM",
+    "FundDate",
+    "SubjectPropertyState",
+    "ProductBucketGroup",
+    "Purpose",
+    "CompensafeBucket",
+    "ActiveSalesHC",
+    "ActiveNonProducingSalesHC",
+    "Compensafe $",
+    "Rent $ (BOM)",
+    "Payroll Reg Earnings $ (BOM)",
+    "SPEC Paid $",
+    "CRA Paid $",
+    "LOS Revenue $",
+    "GL Fee Income $",
+    "GL GOS $",
+    "GL OI $",
+    "GL Exception $",
+    "LOS Exception $",
+    "LLR $",
+    "Corporate Allocation $",
+]
+AMOUNT_COLUMNS = len(HEADERS) - 11
+VPS = [f"VP {i:03d}" for i in range(120)]
+STATES = ["PA", "MO", "TX", "CA", "NY", "FL", "OH", "NJ", "IL", "GA"]
+PRODUCTS = ["Conventional", "FHA", "VA", "Jumbo", "USDA"]
+PURPOSES = ["Purchase", "Refi", "Cash-Out Refi"]
+MONTHS = 24
+# report months are first-of-month dates (2024-01-01 onwards) as Excel serials, like the real sources
+BOM_SERIALS = [(dt.date(2024 + k // 12, k % 12 + 1, 1) - dt.date(1899, 12, 30)).days for k in range(MONTHS)]
+# part of the cached workbook names; bump it when the generator changes so old files are not reused
+DATA_VERSION = 2
+DUPLICATE_RATE = 0.35  # share of rows that repeat a recent (loan, vp, bom) key
+DRIFT_RATE = 0.03  # share of repeated rows whose dimensions disagree with the first row
+NO_LOAN_RATE = 0.04
+RECENT_KEYS = 50000
+STAGES = ["shared_strings", "sheet_parse", "dedupe", "kpi_rollup", "csv_write", "xlsx_write"]
+DEFAULT_SIZES = "10k,1M"
+DEFAULT_INPUTS = "csv,csv.gz"
+DATE_HEADERS = {"BOM", "FundDate"}
+
+
+def parse_count(text):
+    text = text.strip().upper()
+    scale = {"K": 1000, "M": 1000000}.get(text[-1:], 1)
+    return int(float(text[:-1] if scale > 1 else text) * scale)
+
+
+def load_build_module():
+    spec = importlib.util.spec_from_file_location("build_vp_dashboard_data", BUILD_SCRIPT)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+def col_ref(n):
+    n += 1
+    out = ""
+    while n:
+        n, r = divmod(n - 1, 26)
+        out = chr(65 + r) + out
+    return out
+
+
+def amount_cell(rnd, ref, value):
+    """A currency cell in one of the shapes the exports contain."""
+    shape = rnd.random()
+    if shape < 0.6:
+        return f'<c r="{ref}"><v>{value}</v></c>'
+    if shape < 0.85:
+        return f'<c r="{ref}" t="inlineStr"><is><t>${value:,.2f}</t></is></c>'
+    if shape < 0.93:
+        return f'<c r="{ref}" t="inlineStr"><is><t>{value:,.2f}</t></is></c>'
+    if shape < 0.97:
+        return None
+    return "NULL"
+
+
+def write_synthetic_workbook(path: Path, rows, seed=7):
+    """Stream a seeded source workbook with ``rows`` data rows to ``path``.
+
+    Repeated loan keys, "No Loan #" bucket rows, missing VPs/states and NULL, ``$``
+    and thousands-separator amounts are mixed in at fixed rates. Labels go through
+    shared strings, formatted amounts are inline strings and loan numbers, dates and
+    plain amounts numeric cells, so memory stays flat at any row count.
+    """
+    rnd = random.Random(seed)
+    shared = {}
+
+    def s(text):
+        idx = shared.get(text)
+        if idx is None:
+            idx = shared[text] = len(shared)
+        return idx
+
+    refs = [col_ref(j) for j in range(len(HEADERS))]
+    recent = []
+    next_loan = 1000000000
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as z:
+        z.writestr(
+            "xl/workbook.xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            '<sheets><sheet name="Data" sheetId="1" r:id="rId1"/></sheets></workbook>',
+        )
+        z.writestr(
+            "xl/_rels/workbook.xml.rels",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+            'Target="worksheets/sheet1.xml"/></Relationships>',
+        )
+        with z.open("xl/worksheets/sheet1.xml", "w", force_zip64=True) as fh:
+            fh.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            header = "".join(f'<c r="{refs[j]}1" t="s"><v>{s(h)}</v></c>' for j, h in enumerate(HEADERS))
+            fh.write(f'<row r="1">{header}</row>'.encode("utf-8"))
+            batch = []
+            for i in range(2, rows + 2):
+                if recent and rnd.random() < DUPLICATE_RATE:
+                    loan, vp, bom, fund, state, product, purpose, amount = rnd.choice(recent)
+                    if rnd.random() < DRIFT_RATE:
+                        fund, state = fund + 1, rnd.choice(STATES)
+                else:
+                    loan, vp, bom = str(next_loan), rnd.choice(VPS), BOM_SERIALS[rnd.randrange(MONTHS)]
+                    fund, state = bom + rnd.randrange(0, 28), rnd.choice(STATES)
+                    product, purpose = rnd.choice(PRODUCTS), rnd.choice(PURPOSES)
+                    amount = rnd.randrange(50, 1500) * 1000
+                    next_loan += rnd.randrange(1, 50)
+                    key = (loan, vp, bom, fund, state, product, purpose, amount)
+                    if len(recent) < RECENT_KEYS:
+                        recent.append(key)
+                    else:
+                        recent[rnd.randrange(RECENT_KEYS)] = key
+                no_loan = rnd.random() < NO_LOAN_RATE
+                cells = []
+                if not no_loan:
+                    cells.append(f'<c r="A{i}"><v>{loan}</v></c>')
+                amt = amount_cell(rnd, f"B{i}", amount)
+                if amt == "NULL":
+                    amt = f'<c r="B{i}" t="s"><v>{s("NULL")}</v></c>'
+                if amt:
+                    cells.append(amt)
+                if rnd.random() > 0.005:
+                    cells.append(f'<c r="C{i}" t="s"><v>{s(vp)}</v></c>')
+                cells.append(f'<c r="D{i}"><v>{bom}</v></c>')
+                cells.append(f'<c r="E{i}"><v>{fund}</v></c>')
+                if rnd.random() > 0.02:
+                    cells.append(f'<c r="F{i}" t="s"><v>{s(state)}</v></c>')
+                cells.append(f'<c r="G{i}" t="s"><v>{s(product)}</v></c>')
+                cells.append(f'<c r="H{i}" t="s"><v>{s(purpose)}</v></c>')
+                cells.append(f'<c r="I{i}" t="s"><v>{s("No Loan #" if no_loan else "Loan")}</v></c>')
+                cells.append(f'<c r="J{i}"><v>{rnd.randrange(1, 60)}</v></c>')
+                cells.append(f'<c r="K{i}"><v>{rnd.randrange(0, 30)}</v></c>')
+                for j in range(11, 11 + AMOUNT_COLUMNS):
+                    ref = f"{refs[j]}{i}"
+                    cell = amount_cell(rnd, ref, round(rnd.uniform(-50, 900), 2))
+                    if cell == "NULL":
+                        cell = f'<c r="{ref}" t="s"><v>{s("NULL")}</v></c>'
+                    if cell:
+                        cells.append(cell)
+                batch.append(f'<row r="{i}">{"".join(cells)}</row>')
+                if len(batch) >= 2000:
+                    fh.write("".join(batch).encode("utf-8"))
+                    batch = []
+            fh.write("".join(batch).encode("utf-8"))
+            fh.write(b"</sheetData></worksheet>")
+        z.writestr(
+            "xl/sharedStrings.xml",
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            f'<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" count="{len(shared)}" '
+            f'uniqueCount="{len(shared)}">' + "".join(f"<si><t>{html.escape(t)}</t></si>" for t in shared) + "</sst>",
+        )
+    return path
+
+
+def synthetic_workbook(data_dir: Path, rows, seed):
+    """Generated workbook for ``rows``/``seed``, reused across runs."""
+    path = data_dir / f"synthetic_{rows}_seed{seed}_v{DATA_VERSION}.xlsx"
+    if not path.exists():
+        tmp = path.with_suffix(".xlsx.tmp")
+        write_synthetic_workbook(tmp, rows, seed)
+        tmp.replace(path)
+    return path
+
+
+def synthetic_delimited(workbook: Path, suffix):
+    """The workbook's rows re-exported as ``.csv``/``.tsv`` (optionally ``.gz``), reused across runs.
+
+    Cells are copied as the build reads them from the xlsx, except that the Excel date
+    serials become ISO dates, as a warehouse extract would have them.
+    """
+    path = workbook.with_suffix("." + suffix)
+    if path.exists():
+        return path
+    m = load_build_module()
+    tmp = path.with_name(path.name + ".tmp")
+    opener = gzip.open if suffix.endswith(".gz") else open
+    with m.open_source_rows(workbook) as it, opener(tmp, "wt", encoding="utf-8", newline="") as fh:
+        w = csv.writer(fh, delimiter=m.source_delimiter(path))
+        header = next(it)
+        w.writerow(header)
+        dates = [i for i, h in enumerate(header) if h in DATE_HEADERS]
+        for row in it:
+            for i in dates:
+                row[i] = m.excel_serial_to_date(row[i]) or ""
+            w.writerow(row)
+    tmp.replace(path)
+    return path
+
+
+def run_read(source, engine="python"):
+    """Parse and dedupe timing for reading ``source`` in any input format the build accepts.
+
+    ``engine="numpy"`` times ``read_source_numpy``, whose dedupe covers the column
+    conversion and the group-by after the read.
+    """
+    m = load_build_module()
+    source = Path(source)
+    clock = time.perf_counter
+    t = clock()
+    in_dedupe = 0.0
+    if engine == "numpy":
+        acc = m.read_source_numpy(source)
+        in_dedupe = acc.timings["dedupe"]
+    else:
+        with m.open_source_rows(source) as it:
+            acc = m.BuildAccumulator(m.resolve_columns(next(it)))
+            add_row = acc.add_row
+            for source_row, row in enumerate(it, start=2):
+                a = clock()
+                add_row(row, source_row)
+                in_dedupe += clock() - a
+    total = clock() - t
+    return {
+        "bytes": source.stat().st_size,
+        "loan_keys": len(acc.loan_level),
+        "parse_seconds": round(total - in_dedupe, 4),
+        "dedupe_seconds": round(in_dedupe, 4),
+        "rows_per_sec": round(acc.raw_rows / total) if total else None,
+        "peak_rss_bytes": m.peak_rss_bytes(),
+    }
+
+
+def run_stages(source):
+    """Time each build stage on ``source``; runs in a fresh process so peak RSS is its own."""
+    m = load_build_module()
+    source = Path(source)
+    timings = {}
+    peaks = {}
+
+    def done(stage, started):
+        timings[stage] = time.perf_counter() - started
+        peaks[stage] = m.peak_rss_bytes()
+
+    with zipfile.ZipFile(source) as zf:
+        t = time.perf_counter()
+        shared = m.parse_shared_strings(zf)
+        done("shared_strings", t)
+
+        # sheet parse and dedupe share one streaming pass; add_row time is split out
+        t = time.perf_counter()
+        it = m.iter_sheet_rows(zf, m.first_sheet_path(zf), shared)
+        acc = m.BuildAccumulator(m.resolve_columns(next(it)))
+        add_row = acc.add_row
+        clock = time.perf_counter
+        in_dedupe = 0.0
+        for source_row, row in enumerate(it, start=2):
+            a = clock()
+            add_row(row, source_row)
+            in_dedupe += clock() - a
+        total = time.perf_counter() - t
+        timings["sheet_parse"] = total - in_dedupe
+        timings["dedupe"] = in_dedupe
+        peaks["sheet_parse"] = peaks["dedupe"] = m.peak_rss_bytes()
+
+    t = time.perf_counter()
+    monthly_rows, loan_rows, exception_rows, _, _ = m.build_tables(acc)
+    done("kpi_rollup", t)
+    tables = [
+        ("vp_kpi_monthly", monthly_rows, m.KPI_HEADERS),
+        ("vp_loan_detail", loan_rows, m.LOAN_HEADERS),
+        ("vp_exception_log", exception_rows, m.EXCEPTION_HEADERS),
+    ]
+    with tempfile.TemporaryDirectory(prefix="vp_bench_") as tmp:
+        outdir = Path(tmp)
+        t = time.perf_counter()
+        for name, rows, headers in tables:
+            m.write_csv(outdir / f"{name}.csv", rows, headers)
+        done("csv_write", t)
+        t = time.perf_counter()
+        m.write_multi_sheet_xlsx(outdir / "vp_dashboard_data.xlsx", tables)
+        done("xlsx_write", t)
+        output_bytes = sum(p.stat().st_size for p in outdir.iterdir())
+
+    rows = acc.raw_rows
+    return {
+        "rows": rows,
+        "loan_detail_rows": len(loan_rows),
+        "loan_keys": len(acc.loan_level),
+        "output_bytes": output_bytes,
+        "stages": {
+            s: {
+                "seconds": round(timings[s], 4),
+                "rows_per_sec": round(rows / timings[s]) if timings[s] else None,
+                "peak_rss_bytes": peaks[s],
+            }
+            for s in STAGES
+        },
+        "total_seconds": round(sum(timings.values()), 4),
+        "peak_rss_bytes": m.peak_rss_bytes(),
+    }
+
+
+def compare(result, baseline, tolerance):
+    """Stage throughput drops and peak-memory growth beyond ``tolerance`` versus ``baseline``."""
+    regressions = []
+    for size, run in result["runs"].items():
+        base = baseline.get("runs", {}).get(size)
+        if not base:
+            continue
+        for stage, cur in run["stages"].items():
+            old = base["stages"].get(stage)
+            if not old or not old["rows_per_sec"] or not cur["rows_per_sec"]:
+                continue
+            if cur["rows_per_sec"] < old["rows_per_sec"] * (1 - tolerance):
+                regressions.append(f"{size} {stage}: {old['rows_per_sec']:,} -> {cur['rows_per_sec']:,} rows/sec")
+        if base.get("peak_rss_bytes") and run["peak_rss_bytes"] > base["peak_rss_bytes"] * (1 + tolerance):
+            regressions.append(f"{size} peak RSS: {base['peak_rss_bytes']:,} -> {run['peak_rss_bytes']:,} bytes")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the VP dashboard build on seeded synthetic workbooks.")
+    parser.add_argument(
+        "--rows",
+        type=str,
+        default=DEFAULT_SIZES,
+        help=f"Comma-separated sizes, e.g. 10k,1M,10M. Default: {DEFAULT_SIZES}.",
+    )
+    parser.add_argument("--seed", type=int, default=7, help="Generator seed. Default: 7.")
+    parser.add_argument(
+        "--data-dir",
+        type=str,
+        default=str(Path(tempfile.gettempdir()) / "vp_dashboard_bench"),
+        help="Where generated workbooks are cached between runs.",
+    )
+    parser.add_argument(
+        "--inputs",
+        type=str,
+        default=DEFAULT_INPUTS,
+        help=f"Delimited formats (csv, tsv, csv.gz, tsv.gz) to read and compare with the xlsx. "
+        f"Default: {DEFAULT_INPUTS}; empty to skip.",
+    )
+    parser.add_argument(
+        "--engines",
+        type=str,
+        default="python",
+        help="Build engines to time the reads with, e.g. python,numpy (numpy needs numpy installed). "
+        "Reads by other engines than python are stored as <format>/<engine>. Default: python.",
+    )
+    parser.add_argument("--out", type=str, default="output/benchmarks/latest.json", help="Result JSON for this run.")
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default="output/benchmarks/baseline.json",
+        help="Baseline JSON to compare against; written from this run if it does not exist yet.",
+    )
+    parser.add_argument("--update-baseline", action="store_true", help="Overwrite the baseline with this run.")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.15, help="Allowed rows/sec drop or peak RSS growth. Default: 0.15."
+    )
+    args = parser.parse_args()
+
+    sizes = [parse_count(s) for s in args.rows.split(",") if s.strip()]
+    data_dir = Path(args.data_dir)
+    data_dir.mkdir(parents=True, exist_ok=True)
+    result = {
+        "generated_at": dt.datetime.now().replace(microsecond=0).isoformat(sep=" "),
+        "seed": args.seed,
+        "python": platform.python_version(),
+        "machine": f"{platform.system()} {platform.machine()}, {os.cpu_count()} CPU",
+        "runs": {},
+    }
+    for rows in sizes:
+        t = time.perf_counter()
+        source = synthetic_workbook(data_dir, rows, args.seed)
+        print(f"{rows:,} rows: {source} ({time.perf_counter() - t:.1f}s to prepare)")
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            run = pool.submit(run_stages, str(source)).result()
+        result["runs"][str(rows)] = run
+        for stage, st in run["stages"].items():
+            print(f"  {stage:<15}{st['seconds']:>10.2f}s{st['rows_per_sec'] or 0:>14,} rows/s")
+        print(f"  peak RSS {run['peak_rss_bytes'] / (1 << 20):,.0f} MiB")
+        # read path per input format on the same rows: xlsx from the stage run, the rest re-exported
+        st = run["stages"]
+        read_seconds = st["shared_strings"]["seconds"] + st["sheet_parse"]["seconds"] + st["dedupe"]["seconds"]
+        run["inputs"] = {
+            "xlsx": {
+                "bytes": source.stat().st_size,
+                "loan_keys": run["loan_keys"],
+                "parse_seconds": round(st["shared_strings"]["seconds"] + st["sheet_parse"]["seconds"], 4),
+                "dedupe_seconds": st["dedupe"]["seconds"],
+                "rows_per_sec": round(rows / read_seconds) if read_seconds else None,
+            }
+        }
+        formats = [f.strip() for f in args.inputs.split(",") if f.strip()]
+        engines = [e.strip() for e in args.engines.split(",") if e.strip()]
+        for fmt in formats:
+            path = synthetic_delimited(source, fmt)
+            if "python" in engines:
+                with ProcessPoolExecutor(max_workers=1) as pool:
+                    run["inputs"][fmt] = pool.submit(run_read, str(path)).result()
+        for engine in engines:
+            if engine == "python":
+                continue
+            for fmt in ["xlsx", *formats]:
+                path = source if fmt == "xlsx" else synthetic_delimited(source, fmt)
+                with ProcessPoolExecutor(max_workers=1) as pool:
+                    run["inputs"][f"{fmt}/{engine}"] = pool.submit(run_read, str(path), engine).result()
+        for fmt, r in run["inputs"].items():
+            print(
+                f"  read {fmt:<16}{r['parse_seconds'] + r['dedupe_seconds']:>10.2f}s{r['rows_per_sec'] or 0:>14,} rows/s"
+                f"  (parse {r['parse_seconds']:.2f}s, {r['bytes'] / (1 << 20):,.1f} MiB, {r['loan_keys']:,} loan keys)"
+            )
+
+    out = (ROOT / args.out).resolve()
+    out.parent.mkdir(parents=True, exist_ok=True)
+    out.write_text(json.dumps(result, indent=2), encoding="utf-8")
+    baseline_path = (ROOT / args.baseline).resolve()
+    if args.update_baseline or not baseline_path.exists():
+        baseline_path.parent.mkdir(parents=True, exist_ok=True)
+        baseline_path.write_text(json.dumps(result, indent=2), encoding="utf-8")
+        print(f"Baseline written: {baseline_path}")
+        return
+    regressions = compare(result, json.loads(baseline_path.read_text(encoding="utf-8")), args.tolerance)
+    for r in regressions:
+        print(f"REGRESSION {r}")
+    if regressions:
+        raise SystemExit(1)
+    print(f"No regressions against {baseline_path} (tolerance {args.tolerance:.0%}).")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,16 +2,40 @@
 from __future__ import annotations
 
 import argparse
+import asyncio
+import cProfile
 import csv
 import datetime as dt
+import glob
+import gzip
 import hashlib
+import heapq
 import html
+import io
+import itertools
 import json
+import math
+import mmap
+import os
+import pickle
 import re
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import urllib.parse
 import zipfile
 import xml.etree.ElementTree as ET
-from collections import defaultdict
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from operator import eq, ge, gt, itemgetter, le, lt, ne
 from pathlib import Path
+from xml.parsers import expat
 
 NS = {
     "a": "http://schemas.openxmlformats.org/spreadsheetml/2006/main",
@@ -54,13 +78,49 @@ def excel_serial_to_date(v):
         return s[:10]
 
 
-def norm(s):
-    return re.sub(r"[^a-z0-9]+", "", (s or "").lower())
+# Raw cells repeat heavily (a few dozen months, recurring amounts), so the date and
+# currency converters sit behind bounded LRU caches keyed by the raw cell string.
+DATE_CACHE_SIZE = 4096
+NUMBER_CACHE_SIZE = 1 << 16
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def cached_date(v):
+    return excel_serial_to_date(v)
+
+
+@lru_cache(maxsize=NUMBER_CACHE_SIZE)
+def cached_num(v):
+    return to_num(v)
+
+
+CACHED_CONVERTERS = {"date": cached_date, "number": cached_num}
+
+
+def cache_counts():
+    """Current ``[hits, misses]`` of each converter cache in this process."""
+    return {k: list(f.cache_info()[:2]) for k, f in CACHED_CONVERTERS.items()}
 
 
-def col_letters(cell_ref):
-    m = re.match(r"([A-Z]+)", cell_ref or "")
-    return m.group(1) if m else ""
+def cache_counts_since(base):
+    return {k: [h - base[k][0], m - base[k][1]] for k, (h, m) in cache_counts().items()}
+
+
+def add_cache_counts(a, b):
+    zero = [0, 0]
+    return {k: [x + y for x, y in zip(a.get(k, zero), b.get(k, zero))] for k in CACHED_CONVERTERS}
+
+
+def cache_hit_rates(counts):
+    out = {}
+    for k, (hits, misses) in counts.items():
+        total = hits + misses
+        out[k] = {"hits": hits, "misses": misses, "hit_rate": round(hits / total, 4) if total else None}
+    return out
+
+
+def norm(s):
+    return re.sub(r"[^a-z0-9]+", "", (s or "").lower())
 
 
 def col_to_idx(col):
@@ -70,17 +130,76 @@ def col_to_idx(col):
     return n - 1
 
 
+class ColumnRefCache(dict):
+    """Maps a cell reference such as ``AB123`` to its 0-based column index.
+
+    Only the column letters are used as the key, so a sheet with millions of rows
+    still decodes each distinct column once.
+    """
+
+    def lookup(self, cell_ref):
+        letters = cell_ref.rstrip("0123456789")
+        idx = self.get(letters)
+        if idx is None:
+            idx = self[letters] = col_to_idx(letters)
+        return idx
+
+
+READ_CHUNK = 1 << 20
+_A = NS["a"] + " "
+_TAG_SI = _A + "si"
+_TAG_T = _A + "t"
+_TAG_ROW = _A + "row"
+_TAG_C = _A + "c"
+_TAG_V = _A + "v"
+
+
+def _new_parser():
+    p = expat.ParserCreate(namespace_separator=" ")
+    p.buffer_text = True
+    p.buffer_size = 1 << 16
+    return p
+
+
 def parse_shared_strings(zf):
     if "xl/sharedStrings.xml" not in zf.namelist():
         return []
-    root = ET.fromstring(zf.read("xl/sharedStrings.xml"))
     out = []
-    for si in root.findall("a:si", NS):
-        t = si.find("a:t", NS)
-        if t is not None:
-            out.append(t.text or "")
-        else:
-            out.append("".join((tt.text or "") for tt in si.findall(".//a:t", NS)))
+    # Per <si>: text of direct <t> children, text of every nested <t> (rich runs).
+    st = {"depth": 0, "si_depth": 0, "in_t": False, "direct_t": False, "direct": [], "runs": []}
+
+    def start(name, attrs):
+        st["depth"] += 1
+        if name == _TAG_SI:
+            st["si_depth"] = st["depth"]
+            st["direct_t"] = False
+            st["direct"] = []
+            st["runs"] = []
+        elif name == _TAG_T and st["si_depth"]:
+            st["in_t"] = True
+            if st["depth"] == st["si_depth"] + 1:
+                st["direct_t"] = True
+
+    def end(name):
+        if name == _TAG_T:
+            st["in_t"] = False
+        elif name == _TAG_SI:
+            out.append("".join(st["direct"] if st["direct_t"] else st["runs"]))
+            st["si_depth"] = 0
+        st["depth"] -= 1
+
+    def chars(data):
+        if st["in_t"]:
+            st["runs"].append(data)
+            if st["depth"] == st["si_depth"] + 1:
+                st["direct"].append(data)
+
+    p = _new_parser()
+    p.StartElementHandler = start
+    p.EndElementHandler = end
+    p.CharacterDataHandler = chars
+    with zf.open("xl/sharedStrings.xml") as fh:
+        p.ParseFile(fh)
     return out
 
 
@@ -93,27 +212,133 @@ def first_sheet_path(zf):
     return "xl/" + rel_map[rid].lstrip("/")
 
 
-def cell_value(c, shared):
-    t = c.attrib.get("t")
-    if t == "s":
-        v = c.find("a:v", NS)
-        return shared[int(v.text)] if v is not None and v.text else ""
-    if t == "inlineStr":
-        return "".join((tt.text or "") for tt in c.findall(".//a:t", NS))
-    v = c.find("a:v", NS)
-    return (v.text or "") if v is not None else ""
-
-
 def iter_sheet_rows(zf, path, shared):
+    """Stream a worksheet as lists of cell strings.
+
+    The first row yielded is the header; its width (last populated column + 1) fixes
+    the length of every later row, so callers can index cells directly. Missing cells
+    are ``""`` and cells past the header width are dropped.
+    """
     with zf.open(path) as fh:
-        for _, elem in ET.iterparse(fh, events=("end",)):
-            if elem.tag.endswith("}row"):
-                row = {}
-                for c in elem.findall("a:c", NS):
-                    idx = col_to_idx(col_letters(c.attrib.get("r", "")))
-                    row[idx] = cell_value(c, shared)
-                yield row
-                elem.clear()
+        yield from iter_xml_rows(iter(lambda: fh.read(READ_CHUNK), b""), shared)
+
+
+def iter_xml_rows(chunks, shared, width=None):
+    """Decode ``<row>`` elements from worksheet XML delivered as byte chunks.
+
+    With ``width=None`` the first row is taken as the header and sets the width;
+    otherwise every row is returned with the given width.
+
+    This is an expat state machine rather than ``ET.iterparse``: no element objects are
+    built and column references go through ``ColumnRefCache``. On a 200k-row synthetic
+    workbook it decodes about 2.5x as many rows/sec as the previous ElementTree reader.
+    """
+    lookup = ColumnRefCache().lookup
+    ready = []
+    row = None
+    col = -1
+    ctype = None
+    capture = False
+    buf = []
+
+    def start(name, attrs):
+        nonlocal row, col, ctype, capture, buf
+        if name == _TAG_C:
+            ref = attrs.get("r")
+            col = lookup(ref) if ref else col + 1
+            ctype = attrs.get("t")
+            buf = []
+        elif name == _TAG_V or name == _TAG_T:
+            capture = True
+        elif name == _TAG_ROW:
+            row = {} if width is None else [""] * width
+            col = -1
+
+    def end(name):
+        nonlocal row, width, capture
+        if name == _TAG_C:
+            val = "".join(buf)
+            if ctype == "s":
+                val = shared[int(val)] if val else ""
+            if width is None or col < width:
+                row[col] = val
+        elif name == _TAG_V or name == _TAG_T:
+            capture = False
+        elif name == _TAG_ROW:
+            if width is None:
+                width = (max(row) + 1) if row else 0
+                header = [""] * width
+                for k, v in row.items():
+                    header[k] = v
+                row = header
+            ready.append(row)
+
+    def chars(data):
+        if capture:
+            buf.append(data)
+
+    p = _new_parser()
+    p.StartElementHandler = start
+    p.EndElementHandler = end
+    p.CharacterDataHandler = chars
+    for chunk in chunks:
+        p.Parse(chunk, False)
+        if ready:
+            yield from ready
+            ready.clear()
+    p.Parse(b"", True)
+    yield from ready
+
+
+# Delimited sources (.csv, .tsv, optionally gzip-compressed) go through the same row
+# contract as iter_sheet_rows, so header resolution and aggregation do not care which
+# format a workbook was exported in.
+DELIMITERS = {".csv": ",", ".tsv": "\t"}
+
+
+def source_delimiter(path: Path):
+    """The field delimiter for a .csv/.tsv(.gz) source, or None for a workbook."""
+    suffixes = [s.lower() for s in path.suffixes[-2:]]
+    if suffixes and suffixes[-1] == ".gz":
+        suffixes.pop()
+    return DELIMITERS.get(suffixes[-1]) if suffixes else None
+
+
+def iter_delimited_rows(path: Path, delimiter):
+    """Stream a delimited text file like ``iter_sheet_rows``: header first (trailing
+    empty headers dropped), every later row padded or cut to the header width and
+    blank lines skipped."""
+    opener = gzip.open if path.suffix.lower() == ".gz" else open
+    with opener(path, "rt", encoding="utf-8-sig", newline="") as fh:
+        reader = csv.reader(fh, delimiter=delimiter)
+        header = next(reader, [])
+        while header and not header[-1]:
+            header.pop()
+        width = len(header)
+        yield header
+        pad = [""] * width
+        for row in reader:
+            if len(row) != width:
+                if not row:
+                    continue
+                row = (row + pad)[:width]
+            yield row
+
+
+@contextmanager
+def open_source_rows(source: Path):
+    """Rows of the first sheet of an xlsx, or of a .csv/.tsv(.gz) file, header first."""
+    delimiter = source_delimiter(source)
+    if delimiter is not None:
+        it = iter_delimited_rows(source, delimiter)
+        try:
+            yield it
+        finally:
+            it.close()
+        return
+    with zipfile.ZipFile(source) as zf:
+        shared = parse_shared_strings(zf)
+        yield iter_sheet_rows(zf, first_sheet_path(zf), shared)
 
 
 def pick(headers, *names):
@@ -140,25 +365,74 @@ def merge_max(existing, incoming):
     return max(existing, incoming)
 
 
+def csv_value(v):
+    """A cell as written to the CSV outputs: floats to at most 6 decimals, None empty."""
+    if isinstance(v, float):
+        return f"{v:.6f}".rstrip("0").rstrip(".")
+    if v is None:
+        return ""
+    return str(v)
+
+
 def write_csv(path: Path, rows, headers):
     path.parent.mkdir(parents=True, exist_ok=True)
     with path.open("w", newline="", encoding="utf-8") as f:
-        w = csv.DictWriter(f, fieldnames=headers)
-        w.writeheader()
+        w = csv.writer(f)
+        w.writerow(headers)
         for r in rows:
-            out = {}
-            for h in headers:
-                v = r.get(h)
-                if isinstance(v, float):
-                    out[h] = f"{v:.6f}".rstrip("0").rstrip(".")
-                elif v is None:
-                    out[h] = ""
-                else:
-                    out[h] = str(v)
-            w.writerow(out)
+            w.writerow([csv_value(v) for v in map(r.get, headers)])
+
+
+# Output column types. DIMENSION_COLUMNS are low-cardinality strings: shared strings in
+# the xlsx, dictionary-encoded in parquet. Columns in none of these sets are floats.
+DATE_COLUMNS = {"report_month", "fund_date"}
+DIMENSION_COLUMNS = {
+    "vp",
+    "state",
+    "product_bucket_group",
+    "purpose",
+    "exception_reason",
+    "grouping_set",
+    "metric",
+    "side",
+}
+TEXT_COLUMNS = DIMENSION_COLUMNS | {"loan_number", "detail", "issue_key"}
+INT_COLUMNS = {
+    "loan_count",
+    "event_no_loan_bucket_rows",
+    "exception_flag",
+    "source_row_count_under_loan_key",
+    "issue_count",
+    "first_source_row",
+    "last_source_row",
+    "months_t3",
+    "months_t6",
+    "months_t12",
+    "position",
+    "rank",
+    "revenue_rank",
+    "margin_pct_rank",
+    "productivity_rank",
+    "roi_rank",
+}
+XLSX_ROW_BATCH = 2000
+EXCEL_EPOCH = dt.date(1899, 12, 30)
+
+
+def iso_to_excel_serial(s):
+    try:
+        return (dt.date.fromisoformat(s) - EXCEL_EPOCH).days
+    except (TypeError, ValueError):
+        return None
 
 
 def write_multi_sheet_xlsx(output_file: Path, sheets_data):
+    """Write ``(name, rows, headers)`` sheets to an xlsx, streaming each sheet's XML.
+
+    Numbers become numeric cells, ``DATE_COLUMNS`` date-formatted serials and
+    ``DIMENSION_COLUMNS`` (plus the header row) shared strings; anything else
+    is an inline string. ``rows`` may be any iterable of dicts.
+    """
     output_file.parent.mkdir(parents=True, exist_ok=True)
 
     def safe_sheet_name(name, used):
@@ -200,6 +474,7 @@ def write_multi_sheet_xlsx(output_file: Path, sheets_data):
         overrides = [
             '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>',
             '<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>',
+            '<Override PartName="/xl/sharedStrings.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sharedStrings+xml"/>',
             '<Override PartName="/docProps/core.xml" ContentType="application/vnd.openxmlformats-package.core-properties+xml"/>',
             '<Override PartName="/docProps/app.xml" ContentType="application/vnd.openxmlformats-officedocument.extended-properties+xml"/>',
         ]
@@ -248,11 +523,13 @@ def write_multi_sheet_xlsx(output_file: Path, sheets_data):
             "xl/styles.xml",
             '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
             '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            '<numFmts count="1"><numFmt numFmtId="164" formatCode="yyyy-mm-dd"/></numFmts>'
             '<fonts count="1"><font><sz val="11"/><name val="Calibri"/></font></fonts>'
             '<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>'
             '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
             '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
-            '<cellXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/></cellXfs>'
+            '<cellXfs count="2"><xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+            '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/></cellXfs>'
             '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
             "</styleSheet>",
         )
@@ -272,29 +549,216 @@ def write_multi_sheet_xlsx(output_file: Path, sheets_data):
                 for s in sheets
             )
             + '<Relationship Id="rIdStyles" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>'
+            '<Relationship Id="rIdSharedStrings" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings" Target="sharedStrings.xml"/>'
             "</Relationships>",
         )
 
+        sst = {}
+        sst_refs = 0
+
+        def shared_idx(txt):
+            nonlocal sst_refs
+            sst_refs += 1
+            idx = sst.get(txt)
+            if idx is None:
+                idx = sst[txt] = len(sst)
+            return idx
+
         for s in sheets:
-            all_rows = [s["headers"]] + [[r.get(h, "") for h in s["headers"]] for r in s["rows"]]
-            rows_xml = []
-            for r_idx, row in enumerate(all_rows, start=1):
-                cells = []
-                for c_idx, val in enumerate(row):
-                    txt = "" if val is None else str(val)
-                    if txt == "":
-                        continue
-                    cells.append(
-                        f'<c r="{col_ref(c_idx)}{r_idx}" t="inlineStr"><is><t xml:space="preserve">{html.escape(txt)}</t></is></c>'
-                    )
-                rows_xml.append(f'<row r="{r_idx}">' + "".join(cells) + "</row>")
-            z.writestr(
-                s["path"],
-                '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
-                '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
-                + "".join(rows_xml)
-                + "</sheetData></worksheet>",
+            headers = s["headers"]
+            refs = [col_ref(i) for i in range(len(headers))]
+            kinds = [
+                "date" if h in DATE_COLUMNS else "shared" if h in DIMENSION_COLUMNS else "text"
+                for h in headers
+            ]
+            date_cache = {}
+            rows = s["rows"]
+            zip64 = not hasattr(rows, "__len__") or len(rows) > 1_000_000
+            with z.open(s["path"], "w", force_zip64=zip64) as fh:
+                fh.write(
+                    b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                    b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+                )
+                header_cells = "".join(
+                    f'<c r="{refs[i]}1" t="s"><v>{shared_idx(str(h))}</v></c>' for i, h in enumerate(headers) if h != ""
+                )
+                batch = [f'<row r="1">{header_cells}</row>']
+                for r_idx, r in enumerate(rows, start=2):
+                    cells = []
+                    for c_idx, h in enumerate(headers):
+                        val = r.get(h)
+                        if val is None or val == "":
+                            continue
+                        ref = refs[c_idx]
+                        if isinstance(val, (int, float)) and not isinstance(val, bool) and math.isfinite(val):
+                            cells.append(f'<c r="{ref}{r_idx}"><v>{val!r}</v></c>')
+                            continue
+                        txt = str(val)
+                        kind = kinds[c_idx]
+                        if kind == "date":
+                            serial = date_cache.get(txt, False)
+                            if serial is False:
+                                serial = date_cache[txt] = iso_to_excel_serial(txt)
+                            if serial is not None:
+                                cells.append(f'<c r="{ref}{r_idx}" s="1"><v>{serial}</v></c>')
+                                continue
+                        if kind == "shared":
+                            cells.append(f'<c r="{ref}{r_idx}" t="s"><v>{shared_idx(txt)}</v></c>')
+                        else:
+                            cells.append(
+                                f'<c r="{ref}{r_idx}" t="inlineStr"><is><t xml:space="preserve">{html.escape(txt)}</t></is></c>'
+                            )
+                    batch.append(f'<row r="{r_idx}">' + "".join(cells) + "</row>")
+                    if len(batch) >= XLSX_ROW_BATCH:
+                        fh.write("".join(batch).encode("utf-8"))
+                        batch.clear()
+                batch.append("</sheetData></worksheet>")
+                fh.write("".join(batch).encode("utf-8"))
+
+        with z.open("xl/sharedStrings.xml", "w") as fh:
+            fh.write(
+                (
+                    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                    '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"'
+                    f' count="{sst_refs}" uniqueCount="{len(sst)}">'
+                ).encode("utf-8")
+            )
+            for txt in sst:
+                fh.write(f'<si><t xml:space="preserve">{html.escape(txt)}</t></si>'.encode("utf-8"))
+            fh.write(b"</sst>")
+
+
+def require_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise SystemExit("--format parquet needs pyarrow: pip install pyarrow")
+    return pa, pq
+
+
+def write_parquet(path: Path, rows, headers):
+    """Write one table as parquet with one row group per ``report_month``.
+
+    Rows are ordered by vp within each month, dimension columns are dictionary-encoded,
+    and column statistics plus a page index are written, so readers can skip months
+    and VPs without scanning the file.
+    """
+    pa, pq = require_pyarrow()
+
+    def column_type(h):
+        if h in DATE_COLUMNS:
+            return pa.date32()
+        if h in INT_COLUMNS:
+            return pa.int64()
+        if h in TEXT_COLUMNS:
+            return pa.string()
+        return pa.float64()
+
+    date_cache = {}
+
+    def to_date(v):
+        d = date_cache.get(v, False)
+        if d is False:
+            try:
+                d = dt.date.fromisoformat(v)
+            except (TypeError, ValueError):
+                d = None
+            date_cache[v] = d
+        return d
+
+    def converter(h):
+        if h in DATE_COLUMNS:
+            return to_date
+        cast = int if h in INT_COLUMNS else str if h in TEXT_COLUMNS else float
+        return lambda v: None if v is None else cast(v)
+
+    converters = {h: converter(h) for h in headers}
+    schema = pa.schema([pa.field(h, column_type(h)) for h in headers])
+    by_month = defaultdict(list)
+    for r in rows:
+        by_month[r.get("report_month")].append(r)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with pq.ParquetWriter(
+        path,
+        schema,
+        compression="snappy",
+        use_dictionary=[h for h in headers if h in DIMENSION_COLUMNS],
+        write_statistics=True,
+        write_page_index=True,
+    ) as writer:
+        for month in sorted(by_month, key=lambda m: (m is None, m or "")):
+            part = sorted(by_month[month], key=lambda r: r.get("vp") or "")
+            cols = {h: [converters[h](r.get(h)) for r in part] for h in headers}
+            writer.write_table(pa.table(cols, schema=schema), row_group_size=len(part))
+
+
+# Created on every table that has all of the columns.
+SQLITE_INDEXES = [("report_month", "vp"), ("loan_number",), ("state", "product_bucket_group")]
+SQLITE_BATCH_ROWS = 5000
+
+
+def write_sqlite(path: Path, tables):
+    """Write the ``(name, rows, headers)`` tables to a SQLite file in one transaction.
+
+    Builds call this on a fresh file in the staging directory: tables get typed
+    columns (dates as ISO text), rows go in through batched ``executemany`` and
+    ``SQLITE_INDEXES`` are created, and publish_outputs then swaps the finished file
+    in with ``os.replace``, so readers see either the previous build or this one.
+    The default rollback journal is kept so the published file is self-contained
+    (a WAL-mode file would carry -wal/-shm sidecars that the swap does not move).
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    def column_type(h):
+        if h in INT_COLUMNS:
+            return "INTEGER"
+        if h in DATE_COLUMNS or h in TEXT_COLUMNS:
+            return "TEXT"
+        return "REAL"
+
+    con = sqlite3.connect(path, isolation_level=None)
+    try:
+        con.execute("BEGIN IMMEDIATE")
+        for name, rows, headers in tables:
+            con.execute(f'DROP TABLE IF EXISTS "{name}"')
+            con.execute(f'CREATE TABLE "{name}" (' + ", ".join(f'"{h}" {column_type(h)}' for h in headers) + ")")
+            insert = f'INSERT INTO "{name}" VALUES (' + ", ".join("?" * len(headers)) + ")"
+            ints = [h in INT_COLUMNS for h in headers]
+            values = (
+                tuple(None if v is None else int(v) if i else v for v, i in zip(map(r.get, headers), ints))
+                for r in rows
             )
+            for batch in iter(lambda: list(itertools.islice(values, SQLITE_BATCH_ROWS)), []):
+                con.executemany(insert, batch)
+            for cols in SQLITE_INDEXES:
+                if all(c in headers for c in cols):
+                    con.execute(
+                        f'CREATE INDEX "ix_{name}_{"_".join(cols)}" ON "{name}" ('
+                        + ", ".join(f'"{c}"' for c in cols)
+                        + ")"
+                    )
+        con.execute("ANALYZE")
+        con.execute("COMMIT")
+    except BaseException:
+        if con.in_transaction:
+            con.execute("ROLLBACK")
+        raise
+    finally:
+        con.close()
+
+
+OUTPUT_FORMATS = ["csv", "xlsx", "parquet", "sqlite"]
+TABLE_NAMES = ["vp_kpi_monthly", "vp_loan_detail", "vp_exception_log"]
+
+
+def parse_formats(value):
+    formats = [f.strip().lower() for f in value.split(",") if f.strip()]
+    unknown = [f for f in formats if f not in OUTPUT_FORMATS]
+    if unknown or not formats:
+        raise argparse.ArgumentTypeError(f"choose from {','.join(OUTPUT_FORMATS)} (got {value!r})")
+    return list(dict.fromkeys(formats))
 
 
 def detect_source_file(root: Path):
@@ -307,176 +771,847 @@ def detect_source_file(root: Path):
     return None
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Build Tableau-ready VP dashboard datasets from raw Excel.")
-    parser.add_argument("--source", type=str, help="Path to source xlsx. Default: newest xlsx in repo root.")
-    parser.add_argument("--outdir", type=str, default="output/tableau_ready", help="Output directory.")
-    args = parser.parse_args()
+KPI_HEADERS = [
+    "report_month",
+    "vp",
+    "loan_count",
+    "loan_volume",
+    "total_revenue",
+    "total_expense",
+    "contribution_margin",
+    "margin_pct",
+    "active_sales_hc",
+    "active_non_producing_sales_hc",
+    "productivity",
+    "bonus_spend_proxy",
+    "roi",
+    "event_compensafe_amt",
+    "event_rent_amt",
+    "event_payroll_amt",
+    "event_no_loan_bucket_rows",
+    "exception_flag",
+    "exception_reason",
+]
+LOAN_HEADERS = [
+    "report_month",
+    "vp",
+    "loan_number",
+    "fund_date",
+    "state",
+    "product_bucket_group",
+    "purpose",
+    "loan_amount",
+    "revenue_total_loan_level",
+    "expense_total_loan_level",
+    "los_revenue_amt",
+    "gl_fee_income_amt",
+    "gl_gos_amt",
+    "gl_oi_amt",
+    "gl_exception_amt",
+    "los_exception_amt",
+    "llr_amt",
+    "corporate_allocation_amt",
+    "source_row_count_under_loan_key",
+]
+EXCEPTION_HEADERS = [
+    "report_month",
+    "vp",
+    "exception_reason",
+    "margin_pct",
+    "roi",
+    "event_no_loan_bucket_rows",
+    "detail",
+    "issue_key",
+]
+
+# --dq-log aggregate: one exception row per (issue_key, issue_type) with these extra columns;
+# --dq-detail keeps every conflict, one per row, in a CSV side file. Both are derived after
+# the read from acc.dq_issues, which every read path keeps whole (multi-workbook and shard
+# merges drop and re-sort issues, incremental state stores them per month), so aggregate
+# mode shrinks the published log, not the build's memory.
+DQ_AGGREGATE_HEADERS = ["issue_count", "first_source_row", "last_source_row"]
+DQ_DETAIL_HEADERS = ["source_row", "source", "issue_key", "issue_type", "current_value", "conflicting_value"]
+DQ_SAMPLE_VALUES = 5
+DQ_DETAIL_TABLE = "dq_issue_detail"
+
+# --rollup: loan totals over ROLLUP_DIMS at the finest grain and at each subtotal level in
+# ROLLUP_GROUPING_SETS. Dimensions a level rolls up are left empty and grouping_set names
+# the ones it keeps, so a loan with no state is told apart from an all-states subtotal.
+ROLLUP_TABLE = "vp_rollup_cube"
+ROLLUP_DIMS = ["report_month", "vp", "state", "product_bucket_group", "purpose"]
+ROLLUP_GROUPING_SETS = [
+    ROLLUP_DIMS,
+    ["report_month", "vp", "state"],
+    ["report_month", "vp", "product_bucket_group"],
+    ["report_month", "vp", "purpose"],
+    ["report_month", "vp"],
+    ["report_month", "state"],
+    ["report_month", "product_bucket_group"],
+    ["report_month", "purpose"],
+    ["report_month"],
+]
+ROLLUP_MEASURES = ["loan_count", "loan_volume", "revenue_loan_level", "expense_loan_level"]
+ROLLUP_HEADERS = ROLLUP_DIMS + ["grouping_set"] + ROLLUP_MEASURES
+
+# --trailing: per-VP trailing-window and period-over-period KPIs, one row per
+# vp_kpi_monthly row. Windows are calendar months ending at the row's month, so a VP's
+# missing months count as empty rather than pulling older months into the window;
+# months_t<N> says how many report months of the window had data.
+TRAILING_TABLE = "vp_kpi_trailing"
+TRAILING_WINDOWS = [3, 6, 12]
+TRAILING_HEADERS = (
+    ["report_month", "vp"]
+    + [f"{m}_t{n}" for n in TRAILING_WINDOWS for m in ["months", "revenue", "margin_pct", "productivity", "roi"]]
+    + ["revenue_mom_pct", "revenue_yoy_pct", "margin_pct_mom_delta", "margin_pct_yoy_delta"]
+)
+
+# --leaderboard: each VP's rank (1 = highest, ties share the best rank) and percentile
+# ((n - rank) / (n - 1) among the n VPs with a value, 1.0 = top) per metric within its
+# report_month, as extra vp_kpi_monthly columns, plus the top and bottom N VPs of each
+# month and metric in vp_leaderboard. VPs without a value are not ranked.
+LEADERBOARD_TABLE = "vp_leaderboard"
+LEADERBOARD_METRICS = {
+    "revenue": "total_revenue",
+    "margin_pct": "margin_pct",
+    "productivity": "productivity",
+    "roi": "roi",
+}
+LEADERBOARD_SIZE = 10
+RANK_HEADERS = [f"{m}_{kind}" for m in LEADERBOARD_METRICS for kind in ["rank", "pctile"]]
+LEADERBOARD_HEADERS = ["report_month", "metric", "side", "position", "vp", "value", "rank", "pctile"]
+
+REV_FIELDS = ["los_rev", "gl_fee", "gl_gos", "gl_oi", "gl_exc", "los_exc"]
+EXP_LOAN_FIELDS = ["llr", "corp_alloc"]
+EVENT_COST_FIELDS = ["comp_amt", "rent_amt", "payroll_amt"]
+BONUS_FIELDS = ["spec_paid_amt", "cra_paid_amt"]
+
+
+def resolve_columns(headers):
+    return {
+        "loan": pick(headers, "Loannumber"),
+        "loan_amount": pick(headers, "LoanAmount"),
+        "vp": pick(headers, "VP"),
+        "bom": pick(headers, "BOM"),
+        "fund_date": pick(headers, "FundDate"),
+        "state": pick(headers, "SubjectPropertyState"),
+        "product": pick(headers, "ProductBucketGroup"),
+        "purpose": pick(headers, "Purpose"),
+        "comp_bucket": pick(headers, "CompensafeBucket"),
+        "active_sales_hc": pick(headers, "ActiveSalesHC"),
+        "active_non_hc": pick(headers, "ActiveNonProducingSalesHC"),
+        "comp_amt": pick(headers, "Compensafe $"),
+        "rent_amt": pick(headers, "Rent $ (BOM)"),
+        "payroll_amt": pick(headers, "Payroll Reg Earnings $ (BOM)"),
+        "spec_paid_amt": pick(headers, "SPEC Paid $"),
+        "cra_paid_amt": pick(headers, "CRA Paid $"),
+        "los_rev": pick(headers, "LOS Revenue $"),
+        "gl_fee": pick(headers, "GL Fee Income $"),
+        "gl_gos": pick(headers, "GL GOS $"),
+        "gl_oi": pick(headers, "GL OI $"),
+        "gl_exc": pick(headers, "GL Exception $"),
+        "los_exc": pick(headers, "LOS Exception $"),
+        "llr": pick(headers, "LLR $"),
+        "corp_alloc": pick(headers, "Corporate Allocation $"),
+    }
 
-    root = Path(__file__).resolve().parents[1]
-    source = Path(args.source).resolve() if args.source else detect_source_file(root)
-    if not source or not source.exists():
-        raise SystemExit("No source xlsx found. Provide --source /path/to/file.xlsx")
 
-    outdir = (root / args.outdir).resolve()
-    outdir.mkdir(parents=True, exist_ok=True)
+# One converter per resolved column; cells of unmapped columns are None.
+COLUMN_KINDS = {
+    "loan": "text",
+    "loan_amount": "number",
+    "vp": "text",
+    "bom": "date",
+    "fund_date": "date",
+    "state": "text",
+    "product": "text",
+    "purpose": "text",
+    "comp_bucket": "text",
+    "active_sales_hc": "number",
+    "active_non_hc": "number",
+    **dict.fromkeys(EVENT_COST_FIELDS + BONUS_FIELDS + REV_FIELDS + EXP_LOAN_FIELDS, "number"),
+}
+CONVERTERS = {"text": clean_text, **CACHED_CONVERTERS}
 
-    loan_level = {}
-    event_monthly = defaultdict(lambda: defaultdict(float))
-    hc_monthly = defaultdict(lambda: {"active_sales_hc": None, "active_non_producing_sales_hc": None})
-    dq_issues = []
-    raw_rows = 0
 
-    with zipfile.ZipFile(source) as zf:
-        shared = parse_shared_strings(zf)
-        sheet = first_sheet_path(zf)
-        it = iter_sheet_rows(zf, sheet, shared)
-        header_map = next(it)
-        width = max(header_map.keys()) + 1
-        headers = [""] * width
-        for k, v in header_map.items():
-            headers[k] = v
-
-        c = {
-            "loan": pick(headers, "Loannumber"),
-            "loan_amount": pick(headers, "LoanAmount"),
-            "vp": pick(headers, "VP"),
-            "bom": pick(headers, "BOM"),
-            "fund_date": pick(headers, "FundDate"),
-            "state": pick(headers, "SubjectPropertyState"),
-            "product": pick(headers, "ProductBucketGroup"),
-            "purpose": pick(headers, "Purpose"),
-            "comp_bucket": pick(headers, "CompensafeBucket"),
-            "active_sales_hc": pick(headers, "ActiveSalesHC"),
-            "active_non_hc": pick(headers, "ActiveNonProducingSalesHC"),
-            "comp_amt": pick(headers, "Compensafe $"),
-            "rent_amt": pick(headers, "Rent $ (BOM)"),
-            "payroll_amt": pick(headers, "Payroll Reg Earnings $ (BOM)"),
-            "spec_paid_amt": pick(headers, "SPEC Paid $"),
-            "cra_paid_amt": pick(headers, "CRA Paid $"),
-            "los_rev": pick(headers, "LOS Revenue $"),
-            "gl_fee": pick(headers, "GL Fee Income $"),
-            "gl_gos": pick(headers, "GL GOS $"),
-            "gl_oi": pick(headers, "GL OI $"),
-            "gl_exc": pick(headers, "GL Exception $"),
-            "los_exc": pick(headers, "LOS Exception $"),
-            "llr": pick(headers, "LLR $"),
-            "corp_alloc": pick(headers, "Corporate Allocation $"),
-        }
+def compile_coercion_plan(c):
+    """``(field, converter, column index)`` for every column ``resolve_columns`` found."""
+    return tuple((f, CONVERTERS[kind], c[f]) for f, kind in COLUMN_KINDS.items() if c.get(f) is not None)
 
-        rev_fields = ["los_rev", "gl_fee", "gl_gos", "gl_oi", "gl_exc", "los_exc"]
-        exp_loan_fields = ["llr", "corp_alloc"]
-        event_cost_fields = ["comp_amt", "rent_amt", "payroll_amt"]
-        bonus_fields = ["spec_paid_amt", "cra_paid_amt"]
-
-        for source_row, raw_map in enumerate(it, start=2):
-            raw_rows += 1
-            row = [""] * width
-            for i, v in raw_map.items():
-                if i < width:
-                    row[i] = v
-
-            loan = get(row, c["loan"])
-            vp = get(row, c["vp"]) or "(Unknown VP)"
-            bom = excel_serial_to_date(get(row, c["bom"])) or "unknown"
-            month_key = (bom, vp)
-
-            # HC monthly (use max to avoid row inflation)
-            hc_monthly[month_key]["active_sales_hc"] = merge_max(
-                hc_monthly[month_key]["active_sales_hc"], to_num(get(row, c["active_sales_hc"]))
-            )
-            hc_monthly[month_key]["active_non_producing_sales_hc"] = merge_max(
-                hc_monthly[month_key]["active_non_producing_sales_hc"], to_num(get(row, c["active_non_hc"]))
-            )
 
-            # Event costs and bonus: row-level sum by VP+month
-            for f in event_cost_fields + bonus_fields:
-                event_monthly[month_key][f] += to_num(get(row, c[f])) or 0.0
-
-            if (get(row, c["comp_bucket"]) or "") == "No Loan #":
-                event_monthly[month_key]["no_loan_bucket_rows"] += 1
-
-            # Loan-level dedupe
-            if loan:
-                lkey = (loan, vp, bom)
-                entry = loan_level.get(lkey)
-                rev_vals = {f: to_num(get(row, c[f])) for f in rev_fields}
-                exp_loan_vals = {f: to_num(get(row, c[f])) for f in exp_loan_fields}
-                if entry is None:
-                    loan_level[lkey] = {
-                        "loan_number": loan,
-                        "vp": vp,
-                        "report_month": bom,
-                        "fund_date": excel_serial_to_date(get(row, c["fund_date"])),
-                        "state": get(row, c["state"]),
-                        "product_bucket_group": get(row, c["product"]),
-                        "purpose": get(row, c["purpose"]),
-                        "loan_amount": to_num(get(row, c["loan_amount"])),
-                        **rev_vals,
-                        **exp_loan_vals,
-                        "row_count": 1,
-                    }
-                else:
-                    entry["row_count"] += 1
-                    # keep first non-null dimensions
-                    for dim in ["fund_date", "state", "product_bucket_group", "purpose", "loan_amount"]:
-                        cur = entry.get(dim)
-                        new = (
-                            excel_serial_to_date(get(row, c["fund_date"]))
-                            if dim == "fund_date"
-                            else to_num(get(row, c["loan_amount"]))
-                            if dim == "loan_amount"
-                            else get(row, c["state"])
-                            if dim == "state"
-                            else get(row, c["product"])
-                            if dim == "product_bucket_group"
-                            else get(row, c["purpose"])
-                        )
-                        if cur is None and new is not None:
-                            entry[dim] = new
-                        elif cur is not None and new is not None and cur != new:
-                            dq_issues.append(
-                                {
-                                    "issue_type": f"inconsistent_{dim}",
-                                    "issue_key": f"{loan}|{vp}|{bom}",
-                                    "detail": f"{dim}: {cur} vs {new} at source row {source_row}",
-                                }
-                            )
-                    # numeric fields choose max to avoid duplicated undercount
-                    for f in rev_fields + exp_loan_fields:
-                        entry[f] = merge_max(entry.get(f), rev_vals.get(f) if f in rev_vals else exp_loan_vals.get(f))
-
-    # Build loan detail output
-    loan_rows = []
-    for v in loan_level.values():
-        rev_total = sum(v.get(f) or 0.0 for f in ["los_rev", "gl_fee", "gl_gos", "gl_oi", "gl_exc", "los_exc"])
-        exp_loan = sum(v.get(f) or 0.0 for f in ["llr", "corp_alloc"])
-        loan_rows.append(
-            {
-                "report_month": v["report_month"],
-                "vp": v["vp"],
-                "loan_number": v["loan_number"],
+def coerce_row(plan, row):
+    """Apply the plan to a padded sheet row, converting each mapped cell exactly once."""
+    v = dict.fromkeys(COLUMN_KINDS)
+    for f, conv, idx in plan:
+        v[f] = conv(row[idx])
+    return v
+
+
+def new_hc_entry():
+    return {"active_sales_hc": None, "active_non_producing_sales_hc": None}
+
+
+LOAN_DIMS = ["fund_date", "state", "product_bucket_group", "purpose", "loan_amount"]
+# vp_loan_detail columns that are stored under a different LoanRecord field
+LOAN_OUTPUT_FIELDS = {
+    "los_revenue_amt": "los_rev",
+    "gl_fee_income_amt": "gl_fee",
+    "gl_gos_amt": "gl_gos",
+    "gl_oi_amt": "gl_oi",
+    "gl_exception_amt": "gl_exc",
+    "los_exception_amt": "los_exc",
+    "llr_amt": "llr",
+    "corporate_allocation_amt": "corp_alloc",
+    "source_row_count_under_loan_key": "row_count",
+}
+
+
+class LoanRecord:
+    """One deduped ``(loan, vp, bom)`` entry, stored in slots instead of a ~20-key dict.
+
+    Text values are interned, so the repeated vp/state/product/date strings are shared
+    across records. ``rec[name]`` and ``rec.get(name)`` accept both field names and
+    ``LOAN_HEADERS`` output names, so the merge code and the writers read records
+    directly and vp_loan_detail needs no per-row dict copy.
+    """
+
+    __slots__ = (
+        "loan_number",
+        "vp",
+        "report_month",
+        *LOAN_DIMS,
+        *REV_FIELDS,
+        *EXP_LOAN_FIELDS,
+        "row_count",
+        "first_source_row",
+    )
+
+    def __init__(self, loan_number, vp, report_month, dims, nums, row_count, first_source_row):
+        self.loan_number = loan_number
+        self.vp = sys.intern(vp)
+        self.report_month = sys.intern(report_month)
+        for f in LOAN_DIMS:
+            self[f] = dims[f]
+        for f in REV_FIELDS + EXP_LOAN_FIELDS:
+            setattr(self, f, nums[f])
+        self.row_count = row_count
+        self.first_source_row = first_source_row
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, LOAN_OUTPUT_FIELDS.get(name, name))
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def __setitem__(self, name, value):
+        setattr(self, name, sys.intern(value) if type(value) is str else value)
+
+    def get(self, name, default=None):
+        return getattr(self, LOAN_OUTPUT_FIELDS.get(name, name), default)
+
+    @property
+    def revenue_total_loan_level(self):
+        return sum(getattr(self, f) or 0.0 for f in REV_FIELDS)
+
+    @property
+    def expense_total_loan_level(self):
+        return sum(getattr(self, f) or 0.0 for f in EXP_LOAN_FIELDS)
+
+    def to_dict(self):
+        return {f: getattr(self, f) for f in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["loan_number"], d["vp"], d["report_month"], d, d, d["row_count"], d["first_source_row"])
+
+
+def new_event_entry():
+    return defaultdict(float)
+
+
+class BuildAccumulator:
+    """Row-level aggregation state for one build, workbook or report_month partition.
+
+    ``loan_level`` is keyed by ``(loan, vp, bom)``, ``event_monthly`` and ``hc_monthly``
+    by ``(bom, vp)``. Each loan entry remembers the source row it first appeared on and
+    each dq issue the row (and, for multi-workbook builds, the workbook) that raised it,
+    so partitions can be merged back into source order.
+    """
+
+    def __init__(self, c, source_name=None):
+        self.c = c
+        self.source_name = source_name
+        self.loan_level = {}
+        self.event_monthly = defaultdict(new_event_entry)
+        self.hc_monthly = defaultdict(new_hc_entry)
+        self.dq_issues = []
+        self.raw_rows = 0
+        self.plan = compile_coercion_plan(c) if c is not None else ()
+        self.cache_counts = {}
+        self.timings = {}
+        # named (multi-workbook) reads keep the (source_row, dims) of each row of a loan
+        # key seen more than once, so merge() can replay them against earlier workbooks
+        self.dims_log = {} if source_name is not None else None
+
+    def add_row(self, row, source_row):
+        self.raw_rows += 1
+        v = coerce_row(self.plan, row)
+
+        loan = v["loan"]
+        vp = v["vp"] or "(Unknown VP)"
+        bom = v["bom"] or "unknown"
+        month_key = (bom, vp)
+
+        # HC monthly (use max to avoid row inflation)
+        hc = self.hc_monthly[month_key]
+        hc["active_sales_hc"] = merge_max(hc["active_sales_hc"], v["active_sales_hc"])
+        hc["active_non_producing_sales_hc"] = merge_max(hc["active_non_producing_sales_hc"], v["active_non_hc"])
+
+        # Event costs and bonus: row-level sum by VP+month
+        ev = self.event_monthly[month_key]
+        for f in EVENT_COST_FIELDS + BONUS_FIELDS:
+            ev[f] += v[f] or 0.0
+
+        if (v["comp_bucket"] or "") == "No Loan #":
+            ev["no_loan_bucket_rows"] += 1
+
+        # Loan-level dedupe
+        if loan:
+            lkey = (loan, vp, bom)
+            entry = self.loan_level.get(lkey)
+            dims = {
                 "fund_date": v["fund_date"],
                 "state": v["state"],
-                "product_bucket_group": v["product_bucket_group"],
+                "product_bucket_group": v["product"],
                 "purpose": v["purpose"],
                 "loan_amount": v["loan_amount"],
-                "revenue_total_loan_level": rev_total,
-                "expense_total_loan_level": exp_loan,
-                "los_revenue_amt": v.get("los_rev"),
-                "gl_fee_income_amt": v.get("gl_fee"),
-                "gl_gos_amt": v.get("gl_gos"),
-                "gl_oi_amt": v.get("gl_oi"),
-                "gl_exception_amt": v.get("gl_exc"),
-                "los_exception_amt": v.get("los_exc"),
-                "llr_amt": v.get("llr"),
-                "corporate_allocation_amt": v.get("corp_alloc"),
-                "source_row_count_under_loan_key": v.get("row_count"),
             }
-        )
+            nums = {f: v[f] for f in REV_FIELDS + EXP_LOAN_FIELDS}
+            if entry is None:
+                self.loan_level[lkey] = LoanRecord(loan, vp, bom, dims, nums, 1, source_row)
+            else:
+                entry["row_count"] += 1
+                self.merge_loan(entry, dims, nums, source_row, self.source_name)
+
+    def merge_loan(self, entry, dims, nums, source_row, source_name):
+        if self.dims_log is not None:
+            lkey = (entry["loan_number"], entry["vp"], entry["report_month"])
+            log = self.dims_log.get(lkey)
+            if log is None:
+                # first repeat: the entry still holds exactly the first row's dimensions
+                log = self.dims_log[lkey] = [(entry["first_source_row"], {d: entry[d] for d in LOAN_DIMS})]
+            log.append((source_row, dims))
+        # keep first non-null dimensions
+        for dim in LOAN_DIMS:
+            cur = entry.get(dim)
+            new = dims.get(dim)
+            if cur is None and new is not None:
+                entry[dim] = new
+            elif cur is not None and new is not None and cur != new:
+                self.dq_issues.append(
+                    {
+                        "issue_type": f"inconsistent_{dim}",
+                        "issue_key": f"{entry['loan_number']}|{entry['vp']}|{entry['report_month']}",
+                        "dim": dim,
+                        "cur": cur,
+                        "new": new,
+                        "source_row": source_row,
+                        "source": source_name,
+                    }
+                )
+        # numeric fields choose max to avoid duplicated undercount
+        for f in REV_FIELDS + EXP_LOAN_FIELDS:
+            entry[f] = merge_max(entry.get(f), nums.get(f))
+
+    def merge(self, other):
+        """Fold in a later workbook's accumulator as if its rows followed this one's.
+
+        Keys new here are taken over with the other workbook's own conflicts. For keys
+        seen in an earlier workbook, the other's rows are replayed from its ``dims_log``
+        against the merged entry and its local conflicts for them are dropped, as
+        merge_shards does for shards; its issues then go in by source row.
+        """
+        self.dims_log = None  # the merged result is not merged again
+        self.raw_rows += other.raw_rows
+        self.cache_counts = add_cache_counts(self.cache_counts, other.cache_counts)
+        for k, v in other.timings.items():
+            self.timings[k] = self.timings.get(k, 0.0) + v
+        for key, hc in other.hc_monthly.items():
+            mine = self.hc_monthly[key]
+            for f, v in hc.items():
+                mine[f] = merge_max(mine[f], v)
+        for key, ev in other.event_monthly.items():
+            mine = self.event_monthly[key]
+            for f, v in ev.items():
+                mine[f] += v
+        start = len(self.dq_issues)
+        logs = other.dims_log or {}
+        replayed = set()
+        for lkey, incoming in other.loan_level.items():
+            entry = self.loan_level.get(lkey)
+            if entry is None:
+                self.loan_level[lkey] = incoming
+                continue
+            replayed.add("|".join(lkey))
+            entry["row_count"] += incoming["row_count"]
+            for source_row, dims in logs.get(lkey) or [(incoming["first_source_row"], incoming)]:
+                self.merge_loan(entry, dims, incoming, source_row, other.source_name)
+        self.dq_issues.extend(d for d in other.dq_issues if d["issue_key"] not in replayed)
+        # sort is stable, so issues raised by the same row keep their dimension order
+        self.dq_issues[start:] = sorted(self.dq_issues[start:], key=itemgetter("source_row"))
+
+
+def merge_partitions(parts):
+    """Combine accumulators whose keys do not overlap (one per report_month) in source order."""
+    parts = list(parts)
+    acc = BuildAccumulator(None, parts[0].source_name if parts else None)
+    loans = []
+    for p in parts:
+        acc.raw_rows += p.raw_rows
+        acc.cache_counts = add_cache_counts(acc.cache_counts, p.cache_counts)
+        loans.extend(p.loan_level.items())
+        acc.event_monthly.update(p.event_monthly)
+        acc.hc_monthly.update(p.hc_monthly)
+        acc.dq_issues.extend(p.dq_issues)
+    loans.sort(key=lambda kv: kv[1]["first_source_row"])
+    acc.loan_level = dict(loans)
+    # sort is stable, so issues raised by the same row keep their dimension order
+    acc.dq_issues.sort(key=lambda d: d["source_row"])
+    return acc
+
+
+class LazyRows:
+    """Sized, re-iterable rows rebuilt by ``factory`` on every pass (e.g. from spill runs)."""
+
+    def __init__(self, factory, n):
+        self.factory = factory
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __iter__(self):
+        return iter(self.factory())
+
+
+def aggregate_dq_issues(issues):
+    """Fold per-row dedupe conflicts into one exception row per ``(issue_key, issue_type)``.
+
+    Issues arrive in source order, so the first and last rows seen are the first and
+    last conflicting source rows. ``detail`` shows the kept value against at most
+    ``DQ_SAMPLE_VALUES`` distinct conflicting values. State is kept in flat dicts of
+    strings and ints, which the cyclic GC leaves untracked; nested containers per key
+    made collections over the whole loan table run again and again. Columns that are
+    always empty for dq rows are left out; the writers treat missing keys as empty.
+    """
+    rows = {}
+    samples = {}
+    for d in issues:
+        key = f"{d['issue_key']}\0{d['issue_type']}"
+        row = rows.get(key)
+        new = str(d["new"])
+        if row is None:
+            rows[key] = {
+                "exception_reason": d["issue_type"],
+                "issue_key": d["issue_key"],
+                "issue_count": 1,
+                "first_source_row": d["source_row"],
+                "last_source_row": d["source_row"],
+                "detail": f"{d['dim']}: {d['cur']} vs ",
+                "source": d.get("source") or "",
+            }
+            samples[key] = new
+            continue
+        row["issue_count"] += 1
+        row["last_source_row"] = d["source_row"]
+        if d.get("source") and d["source"] not in row["source"].split(", "):
+            row["source"] += ", " + d["source"]
+        seen = samples[key].split("\x1f")
+        # one value past the cap is kept only to mark the sample as truncated
+        if len(seen) <= DQ_SAMPLE_VALUES and new not in seen:
+            samples[key] += "\x1f" + new
+    for key, row in rows.items():
+        seen = samples.pop(key).split("\x1f")
+        row["detail"] += ", ".join(seen[:DQ_SAMPLE_VALUES]) + (", ..." if len(seen) > DQ_SAMPLE_VALUES else "")
+        source = row.pop("source")
+        if source:
+            row["detail"] += f" in {source}"
+    return list(rows.values())
+
+
+def dq_detail_row(d):
+    return {
+        "source_row": d["source_row"],
+        "source": d.get("source"),
+        "issue_key": d["issue_key"],
+        "issue_type": d["issue_type"],
+        "current_value": d["cur"],
+        "conflicting_value": d["new"],
+    }
+
+
+def month_index(report_month):
+    """Calendar month number of an ISO ``report_month`` (year * 12 + month - 1), or None."""
+    try:
+        return int(report_month[:4]) * 12 + int(report_month[5:7]) - 1
+    except (TypeError, ValueError):
+        return None
+
+
+def trailing_kpis(monthly_rows):
+    """Trailing-window and MoM/YoY KPIs for each ``vp_kpi_monthly`` row, in the same order.
+
+    Each VP's report months form a date-ordered series. A row's N-month window holds
+    its own report month and the VP's earlier ones whose calendar month is less than N
+    months back; each window keeps running sums that are updated as report months
+    enter and leave a deque, so every month is added and removed once per window
+    length. Two report months in one calendar month stay separate points, and the
+    later one's window includes the earlier one. Over a window, margin_pct is margin /
+    revenue, productivity is revenue / active sales HC summed over the months that have
+    HC (revenue per head-month) and roi is revenue / bonus spend. MoM and YoY compare
+    with the VP's latest report month in the calendar month one and twelve months back
+    and are empty when that month has no row. Rows whose report_month is not a date get
+    no trailing values.
+    """
+    # per VP and report month: revenue, margin, revenue in months with HC, HC, bonus spend
+    by_vp = defaultdict(dict)
+    for r in monthly_rows:
+        if month_index(r["report_month"]) is None:
+            continue
+        hc = r["active_sales_hc"]
+        by_vp[r["vp"]][r["report_month"]] = [
+            r["total_revenue"],
+            r["contribution_margin"],
+            r["total_revenue"] if hc else 0.0,
+            hc or 0.0,
+            r["bonus_spend_proxy"],
+        ]
+
+    def ratio(a, b):
+        return a / b if b else None
+
+    def change_pct(cur, prev):
+        return (cur - prev) / abs(prev) if prev else None
+
+    def change(cur, prev):
+        return None if cur is None or prev is None else cur - prev
+
+    out = {}
+    for vp, months in by_vp.items():
+        order = sorted(months)  # ISO dates sort chronologically
+        index = {rm: month_index(rm) for rm in order}
+        latest = {index[rm]: rm for rm in order}  # calendar month -> VP's last report month in it
+        for rm in order:
+            out[(vp, rm)] = {}
+        for n in TRAILING_WINDOWS:
+            window = deque()
+            totals = [0.0] * 5
+            for rm in order:
+                window.append(rm)
+                for j, v in enumerate(months[rm]):
+                    totals[j] += v
+                while index[window[0]] <= index[rm] - n:
+                    for j, v in enumerate(months[window.popleft()]):
+                        totals[j] -= v
+                row = out[(vp, rm)]
+                row[f"months_t{n}"] = len(window)
+                row[f"revenue_t{n}"] = totals[0]
+                row[f"margin_pct_t{n}"] = ratio(totals[1], totals[0])
+                row[f"productivity_t{n}"] = ratio(totals[2], totals[3])
+                row[f"roi_t{n}"] = ratio(totals[0], totals[4])
+        for rm in order:
+            cur = months[rm]
+            prev, last_year = latest.get(index[rm] - 1), latest.get(index[rm] - 12)
+            row = out[(vp, rm)]
+            margin = ratio(cur[1], cur[0])
+            if prev is not None:
+                prev = months[prev]
+                row["revenue_mom_pct"] = change_pct(cur[0], prev[0])
+                row["margin_pct_mom_delta"] = change(margin, ratio(prev[1], prev[0]))
+            if last_year is not None:
+                last_year = months[last_year]
+                row["revenue_yoy_pct"] = change_pct(cur[0], last_year[0])
+                row["margin_pct_yoy_delta"] = change(margin, ratio(last_year[1], last_year[0]))
+
+    rows = []
+    for r in monthly_rows:
+        row = {"report_month": r["report_month"], "vp": r["vp"]}
+        row.update(out.get((r["vp"], r["report_month"]), ()))
+        rows.append(row)
+    return rows
+
+
+# Exception rules. A rule set (DEFAULT_RULES, or the JSON list given with --rules) is
+# compiled once into a plan; each rule then runs over whole columns of its table
+# ("monthly" = vp_kpi_monthly, "loans" = vp_loan_detail) and returns a hit flag per row.
+# Rule names are the exception_reason values, joined with "," in rule order.
+#   compare     column <op> value              (op: > >= < <= == !=)
+#   outside     column below min or above max  (either bound may be omitted)
+#   change      column vs the same VP `months` calendar months back (default 1), as a
+#               relative change unless "relative": false, then <op> value
+#   percentile  column within the "bottom" or "top" share of its report_month peers,
+#               for groups of at least min_peers (default 5) non-empty values
+# Empty values never hit. Loan rule hits are added to vp_exception_log with the loan's
+# issue_key.
+DEFAULT_RULES = [
+    {"name": "contains_no_loan_bucket_rows", "type": "compare", "column": "event_no_loan_bucket_rows", "op": ">", "value": 0},
+    {"name": "margin_outlier", "type": "outside", "column": "margin_pct", "min": -0.5, "max": 0.9},
+    {"name": "roi_outlier", "type": "outside", "column": "roi", "min": 0, "max": 15},
+]
+RULE_TABLES = {"monthly": KPI_HEADERS, "loans": LOAN_HEADERS}
+RULE_OPS = {">": gt, ">=": ge, "<": lt, "<=": le, "==": eq, "!=": ne}
+
+
+def load_rules(path: Path):
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError) as e:
+        raise SystemExit(f"Cannot read rules file {path}: {e}")
+    # compile_rules rejects anything that is not a list, including a dict without "rules"
+    return data.get("rules") if isinstance(data, dict) else data
+
+
+def compile_rules(rules):
+    """Validate ``rules`` and turn each into ``{name, table, columns, test, hits, seconds}``.
+
+    ``test(cols)`` takes the table as ``{column: list of values}`` and returns a
+    bytearray of hit flags. Every problem, down to the wrong JSON shape, exits with
+    a message naming the rule.
+    """
+
+    def fail(rule, msg):
+        label = rule.get("name") if isinstance(rule, dict) else None
+        raise SystemExit(f"Exception rule {label or rule!r}: {msg}")
+
+    def is_number(v):
+        return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+    def op_of(rule):
+        if rule.get("op") not in RULE_OPS:
+            fail(rule, f"op must be one of {' '.join(RULE_OPS)}")
+        if not is_number(rule.get("value")):
+            fail(rule, "value must be a number")
+        return RULE_OPS[rule["op"]], rule["value"]
+
+    def positive_int(rule, key, default):
+        v = rule.get(key, default)
+        if not isinstance(v, int) or isinstance(v, bool) or v < 1:
+            fail(rule, f"{key} must be a positive whole number")
+        return v
+
+    if not isinstance(rules, list):
+        raise SystemExit('Exception rules must be a list of rules or {"rules": [...]}')
+    plan = []
+    for rule in rules:
+        if not isinstance(rule, dict):
+            fail(rule, "must be an object")
+        name, table, col = rule.get("name"), rule.get("table", "monthly"), rule.get("column")
+        if not isinstance(name, str) or not name or "," in name:
+            fail(rule, "needs a name without commas")
+        if any(p["name"] == name for p in plan):
+            fail(rule, "duplicate name")
+        if not isinstance(table, str) or table not in RULE_TABLES:
+            fail(rule, f"table must be one of {', '.join(RULE_TABLES)}")
+        if not isinstance(col, str) or col not in RULE_TABLES[table]:
+            fail(rule, f"unknown {table} column {col!r}")
+        if col in TEXT_COLUMNS or col in DATE_COLUMNS:
+            fail(rule, f"column {col!r} is not numeric")
+        kind = rule.get("type")
+        columns = [col]
+        if kind == "compare":
+            op, value = op_of(rule)
+
+            def test(cols, col=col, op=op, value=value):
+                return bytearray(v is not None and op(v, value) for v in cols[col])
+
+        elif kind == "outside":
+            lo, hi = rule.get("min"), rule.get("max")
+            if lo is None and hi is None:
+                fail(rule, "needs min and/or max")
+            if any(v is not None and not is_number(v) for v in (lo, hi)):
+                fail(rule, "min and max must be numbers")
+            lo = -math.inf if lo is None else lo
+            hi = math.inf if hi is None else hi
+
+            def test(cols, col=col, lo=lo, hi=hi):
+                return bytearray(v is not None and (v < lo or v > hi) for v in cols[col])
+
+        elif kind == "change":
+            op, value = op_of(rule)
+            months, relative = positive_int(rule, "months", 1), rule.get("relative", True)
+            if not isinstance(relative, bool):
+                fail(rule, "relative must be true or false")
+            columns += ["report_month", "vp"]
+
+            def test(cols, col=col, op=op, value=value, months=months, relative=relative):
+                idx = list(map(month_index, cols["report_month"]))
+                by_month = {(vp, i): v for vp, i, v in zip(cols["vp"], idx, cols[col]) if i is not None}
+                hits = bytearray(len(idx))
+                for k, (vp, i, v) in enumerate(zip(cols["vp"], idx, cols[col])):
+                    prev = by_month.get((vp, i - months)) if i is not None else None
+                    if v is None or prev is None or (relative and not prev):
+                        continue
+                    hits[k] = op((v - prev) / abs(prev) if relative else v - prev, value)
+                return hits
+
+        elif kind == "percentile":
+            bottom, top = rule.get("bottom"), rule.get("top")
+            if (bottom is None) == (top is None):
+                fail(rule, "needs exactly one of bottom or top (a share between 0 and 1)")
+            share = top if bottom is None else bottom
+            if not is_number(share) or not 0 < share <= 1:
+                fail(rule, "bottom/top must be a share in (0, 1]")
+            min_peers = positive_int(rule, "min_peers", 5)
+            columns += ["report_month"]
+
+            def test(cols, col=col, bottom=bottom, top=top, min_peers=min_peers):
+                groups = defaultdict(list)
+                for m, v in zip(cols["report_month"], cols[col]):
+                    if v is not None:
+                        groups[m].append(v)
+                for vals in groups.values():
+                    vals.sort()
+                hits = bytearray(len(cols[col]))
+                for k, (m, v) in enumerate(zip(cols["report_month"], cols[col])):
+                    vals = groups.get(m)
+                    if v is None or len(vals) < min_peers:
+                        continue
+                    if bottom is not None:
+                        hits[k] = bisect_left(vals, v) / len(vals) < bottom
+                    else:
+                        hits[k] = (len(vals) - bisect_right(vals, v)) / len(vals) < top
+                return hits
+
+        else:
+            fail(rule, "type must be compare, outside, change or percentile")
+        plan.append({"name": name, "table": table, "columns": columns, "test": test, "hits": 0, "seconds": 0.0})
+    return plan
 
-    # Build monthly KPI output
+
+def evaluate_rules(plan, table, rows):
+    """Reasons per row of ``rows`` (a list, or None without hits) for the plan's ``table`` rules.
+
+    The needed columns are pulled out in one pass over the rows; each rule then runs
+    over those lists, and its hit count and time are added to the plan entry.
+    """
+    rules = [p for p in plan if p["table"] == table]
+    if not rules:
+        return None
+    needed = list(dict.fromkeys(c for p in rules for c in p["columns"]))
+    values = [[r.get(c) for c in needed] for r in rows]
+    cols = {c: [v[j] for v in values] for j, c in enumerate(needed)}
+    del values
+    reasons = [None] * len(cols[needed[0]])
+    for p in rules:
+        t = time.perf_counter()
+        hits = p["test"](cols)
+        for k in itertools.compress(range(len(hits)), hits):
+            if reasons[k] is None:
+                reasons[k] = [p["name"]]
+            else:
+                reasons[k].append(p["name"])
+        p["hits"] += sum(hits)
+        p["seconds"] += time.perf_counter() - t
+    return reasons
+
+
+def rule_stats(plan):
+    return {p["name"]: {"table": p["table"], "hits": p["hits"], "seconds": round(p["seconds"], 4)} for p in plan}
+
+
+def rules_fingerprint(rules):
+    return hashlib.sha1(json.dumps(rules, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def rollup_cube(cells, sums):
+    """Rows for every ``ROLLUP_GROUPING_SETS`` level from the finest-grain cube cells.
+
+    ``cells`` maps a ``ROLLUP_DIMS`` key (missing values as ``""`` so keys sort without
+    a key function) to its offset in ``sums``, which holds the ``ROLLUP_MEASURES`` of
+    each cell back to back. Each level is summed from the smallest level already built
+    that has all of its dimensions, so only the first few passes touch every cell.
+    Subtotals therefore add in a different order than per-loan sums (e.g.
+    vp_kpi_monthly) and can differ from them in the last bits of a float.
+    """
+    width = len(ROLLUP_MEASURES)
+    levels = {tuple(ROLLUP_DIMS): {key: sums[off : off + width] for key, off in cells.items()}}
+    for dims in ROLLUP_GROUPING_SETS:
+        dims = tuple(dims)
+        if dims in levels:
+            continue
+        parent = min((p for p in levels if set(dims) <= set(p)), key=lambda p: len(levels[p]))
+        project = itemgetter(*(parent.index(d) for d in dims))
+        totals = {}
+        for key, v in levels[parent].items():
+            sub = project(key) if len(dims) > 1 else (project(key),)
+            t = totals.get(sub)
+            if t is None:
+                totals[sub] = array("d", v)
+            else:
+                for j in range(width):
+                    t[j] += v[j]
+        levels[dims] = totals
+
+    rows = []
+    for dims in ROLLUP_GROUPING_SETS:
+        label = ",".join(dims)
+        level = levels[tuple(dims)]
+        for sub in sorted(level):
+            row = {d: v or None for d, v in zip(dims, sub)}
+            row["grouping_set"] = label
+            row.update(zip(ROLLUP_MEASURES, level[sub]))
+            row["loan_count"] = int(row["loan_count"])
+            rows.append(row)
+    return rows
+
+
+def rank_month(rows, size, board):
+    """Set RANK_HEADERS on one report_month's KPI rows; append its top/bottom ``size`` to ``board``.
+
+    Each metric is ordered once over the month's VPs; the leaderboard entries are the
+    two ends of that order.
+    """
+    for metric, col in LEADERBOARD_METRICS.items():
+        ranked = sorted((r for r in rows if r[col] is not None), key=itemgetter(col), reverse=True)
+        n = len(ranked)
+        rank, prev = 0, None
+        for i, r in enumerate(ranked, start=1):
+            if r[col] != prev:
+                rank, prev = i, r[col]
+            r[f"{metric}_rank"] = rank
+            r[f"{metric}_pctile"] = (n - rank) / (n - 1) if n > 1 else 1.0
+        for side, ends in (("top", ranked[:size]), ("bottom", ranked[: -size - 1 : -1])):
+            for position, r in enumerate(ends, start=1):
+                board.append(
+                    {
+                        "report_month": r["report_month"],
+                        "metric": metric,
+                        "side": side,
+                        "position": position,
+                        "vp": r["vp"],
+                        "value": r[col],
+                        "rank": r[f"{metric}_rank"],
+                        "pctile": r[f"{metric}_pctile"],
+                    }
+                )
+
+
+def build_tables(acc, dq_log="rows", rollup=False, rules=None, scale=1.0, leaderboard=None):
+    """KPI, loan detail and exception tables, plus the --rollup cube and --leaderboard rows (else None).
+
+    ``rules`` is a compile_rules plan (default: DEFAULT_RULES); its hit counts and
+    timings are updated in place. ``scale`` multiplies the SAMPLE_SCALED_COLUMNS of
+    vp_kpi_monthly before the rules run (--sample-scale). ``leaderboard`` is the
+    top/bottom list size; the KPI rows come out in (report_month, vp) order, so each
+    month is ranked as soon as its last row is built.
+    """
+    # Loan detail rows are the LoanRecords themselves (spilled by --max-memory: re-read from disk)
+    loan_rows = acc.loan_level.values() if isinstance(acc.loan_level, dict) else acc.loan_level
+
+    # Build monthly KPI output; the rollup cube's finest cells fill in the same pass
     monthly_acc = {}
+    cube_cells = {}
+    cube_sums = array("d")
+    cube_zeros = array("d", [0.0] * len(ROLLUP_MEASURES))
     for l in loan_rows:
         key = (l["report_month"], l["vp"])
         m = monthly_acc.get(key)
@@ -490,17 +1625,35 @@ def main():
                 "expense_loan_level": 0.0,
             }
             monthly_acc[key] = m
+        volume = l["loan_amount"] or 0.0
+        revenue = l["revenue_total_loan_level"] or 0.0
+        expense = l["expense_total_loan_level"] or 0.0
         m["loan_count"] += 1
-        m["loan_volume"] += l["loan_amount"] or 0.0
-        m["revenue_loan_level"] += l["revenue_total_loan_level"] or 0.0
-        m["expense_loan_level"] += l["expense_total_loan_level"] or 0.0
+        m["loan_volume"] += volume
+        m["revenue_loan_level"] += revenue
+        m["expense_loan_level"] += expense
+        if rollup:
+            ckey = (*key, l.state or "", l.product_bucket_group or "", l.purpose or "")
+            off = cube_cells.get(ckey)
+            if off is None:
+                off = cube_cells[ckey] = len(cube_sums)
+                cube_sums.extend(cube_zeros)
+            cube_sums[off] += 1
+            cube_sums[off + 1] += volume
+            cube_sums[off + 2] += revenue
+            cube_sums[off + 3] += expense
 
     monthly_rows = []
     exception_rows = []
+    board = [] if leaderboard else None
+    month_start = 0
     for key, m in sorted(monthly_acc.items()):
         bom, vp = key
-        ev = event_monthly.get(key, {})
-        hc = hc_monthly.get(key, {})
+        if leaderboard and monthly_rows and monthly_rows[-1]["report_month"] != bom:
+            rank_month(monthly_rows[month_start:], leaderboard, board)
+            month_start = len(monthly_rows)
+        ev = acc.event_monthly.get(key, {})
+        hc = acc.hc_monthly.get(key, {})
 
         event_cost = (ev.get("comp_amt", 0.0) + ev.get("rent_amt", 0.0) + ev.get("payroll_amt", 0.0))
         bonus_spend = ev.get("spec_paid_amt", 0.0) + ev.get("cra_paid_amt", 0.0)
@@ -512,14 +1665,6 @@ def main():
         productivity = (total_revenue / active_hc) if active_hc not in (None, 0) else None
         roi = (total_revenue / bonus_spend) if bonus_spend else None
 
-        reason = []
-        if (ev.get("no_loan_bucket_rows", 0) or 0) > 0:
-            reason.append("contains_no_loan_bucket_rows")
-        if margin_pct is not None and (margin_pct < -0.5 or margin_pct > 0.9):
-            reason.append("margin_outlier")
-        if roi is not None and (roi < 0 or roi > 15):
-            reason.append("roi_outlier")
-
         row = {
             "report_month": bom,
             "vp": vp,
@@ -538,127 +1683,2069 @@ def main():
             "event_rent_amt": ev.get("rent_amt", 0.0),
             "event_payroll_amt": ev.get("payroll_amt", 0.0),
             "event_no_loan_bucket_rows": ev.get("no_loan_bucket_rows", 0),
-            "exception_flag": 1 if reason else 0,
-            "exception_reason": ",".join(reason) if reason else None,
+            "exception_flag": 0,
+            "exception_reason": None,
         }
+        if scale != 1.0:
+            for col in SAMPLE_SCALED_COLUMNS:
+                if row[col] is not None:
+                    row[col] *= scale
+            row["loan_count"] = round(row["loan_count"])
+            row["event_no_loan_bucket_rows"] = round(row["event_no_loan_bucket_rows"])
         monthly_rows.append(row)
+    if leaderboard and monthly_rows:
+        rank_month(monthly_rows[month_start:], leaderboard, board)
+
+    # Exception rules run over the finished tables, one column-wise pass per rule
+    plan = compile_rules(DEFAULT_RULES) if rules is None else rules
+    reasons = evaluate_rules(plan, "monthly", monthly_rows) or ()
+    for row, reason in zip(monthly_rows, reasons):
+        if reason:
+            row["exception_flag"] = 1
+            row["exception_reason"] = ",".join(reason)
+            exception_rows.append(
+                {
+                    "report_month": row["report_month"],
+                    "vp": row["vp"],
+                    "exception_reason": row["exception_reason"],
+                    "margin_pct": row["margin_pct"],
+                    "roi": row["roi"],
+                    "event_no_loan_bucket_rows": row["event_no_loan_bucket_rows"],
+                }
+            )
+    reasons = evaluate_rules(plan, "loans", loan_rows) or ()
+    columns = {p["name"]: p["columns"][0] for p in plan}
+    for l, reason in zip(loan_rows, reasons):
         if reason:
             exception_rows.append(
                 {
-                    "report_month": bom,
-                    "vp": vp,
+                    "report_month": l["report_month"],
+                    "vp": l["vp"],
                     "exception_reason": ",".join(reason),
-                    "margin_pct": margin_pct,
-                    "roi": roi,
-                    "event_no_loan_bucket_rows": ev.get("no_loan_bucket_rows", 0),
+                    "detail": "; ".join(f"{columns[n]}: {csv_value(l.get(columns[n]))}" for n in reason),
+                    "issue_key": f"{l['loan_number']}|{l['vp']}|{l['report_month']}",
                 }
             )
 
     # Add data quality exceptions from dedupe conflicts
-    for d in dq_issues:
-        exception_rows.append(
-            {
-                "report_month": None,
-                "vp": None,
-                "exception_reason": d["issue_type"],
-                "margin_pct": None,
-                "roi": None,
-                "event_no_loan_bucket_rows": None,
-                "detail": d["detail"],
-                "issue_key": d["issue_key"],
-            }
+    def issue_row(d):
+        return {
+            "report_month": None,
+            "vp": None,
+            "exception_reason": d["issue_type"],
+            "margin_pct": None,
+            "roi": None,
+            "event_no_loan_bucket_rows": None,
+            "detail": f"{d['dim']}: {d['cur']} vs {d['new']} at source row {d['source_row']}"
+            + (f" in {d['source']}" if d.get("source") else ""),
+            "issue_key": d["issue_key"],
+        }
+
+    if dq_log == "aggregate":
+        exception_rows.extend(aggregate_dq_issues(acc.dq_issues))
+    elif isinstance(acc.dq_issues, list):
+        exception_rows.extend(map(issue_row, acc.dq_issues))
+    else:
+        monthly_exceptions = exception_rows
+        exception_rows = LazyRows(
+            lambda: itertools.chain(monthly_exceptions, map(issue_row, acc.dq_issues)),
+            len(monthly_exceptions) + len(acc.dq_issues),
         )
 
-    kpi_headers = [
-        "report_month",
-        "vp",
-        "loan_count",
-        "loan_volume",
-        "total_revenue",
-        "total_expense",
-        "contribution_margin",
-        "margin_pct",
-        "active_sales_hc",
-        "active_non_producing_sales_hc",
-        "productivity",
-        "bonus_spend_proxy",
-        "roi",
-        "event_compensafe_amt",
-        "event_rent_amt",
-        "event_payroll_amt",
-        "event_no_loan_bucket_rows",
-        "exception_flag",
-        "exception_reason",
-    ]
-    loan_headers = [
-        "report_month",
-        "vp",
-        "loan_number",
-        "fund_date",
-        "state",
-        "product_bucket_group",
-        "purpose",
-        "loan_amount",
-        "revenue_total_loan_level",
-        "expense_total_loan_level",
-        "los_revenue_amt",
-        "gl_fee_income_amt",
-        "gl_gos_amt",
-        "gl_oi_amt",
-        "gl_exception_amt",
-        "los_exception_amt",
-        "llr_amt",
-        "corporate_allocation_amt",
-        "source_row_count_under_loan_key",
-    ]
-    exception_headers = [
-        "report_month",
-        "vp",
-        "exception_reason",
-        "margin_pct",
-        "roi",
-        "event_no_loan_bucket_rows",
-        "detail",
-        "issue_key",
+    rollup_rows = rollup_cube(cube_cells, cube_sums) if rollup else None
+    return monthly_rows, loan_rows, exception_rows, rollup_rows, board
+
+
+def file_sha1(path: Path):
+    h = hashlib.sha1()
+    with path.open("rb") as fh:
+        for chunk in iter(lambda: fh.read(READ_CHUNK), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def output_paths(outdir: Path, formats=("csv", "xlsx"), side_tables=(), tables=TABLE_NAMES):
+    paths = []
+    if "csv" in formats:
+        paths += [outdir / f"{t}.csv" for t in tables]
+    if "xlsx" in formats:
+        paths.append(outdir / "vp_dashboard_data.xlsx")
+    if "parquet" in formats:
+        paths += [outdir / f"{t}.parquet" for t in tables]
+    if "sqlite" in formats:
+        paths.append(outdir / "vp_dashboard_data.sqlite")
+    paths += [outdir / f"{t}.csv" for t in side_tables]
+    return paths
+
+
+def peak_rss_bytes():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def cpu_seconds():
+    """User + system CPU of this process and its finished children (pool workers)."""
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+@contextmanager
+def timed(stages, name, rows=None, cpu=cpu_seconds):
+    """Record wall/CPU seconds, rows and process peak RSS for one phase into ``stages[name]``.
+
+    The yielded dict is the stage entry, so callers can fill in rows or output
+    sizes once they are known. Phases run on a worker thread pass
+    ``cpu=time.thread_time`` so overlapping phases are not double-counted; their
+    ``cpu_seconds`` is that thread's alone and does not add up to the process-wide
+    figure of the enclosing phase. ``process_peak_rss_bytes`` is ``ru_maxrss``, the
+    peak of the whole process so far, not memory used by this phase.
+    """
+    entry = stages[name] = {"rows": rows}
+    wall, cpu_start = time.perf_counter(), cpu()
+    try:
+        yield entry
+    finally:
+        entry["wall_seconds"] = round(time.perf_counter() - wall, 4)
+        entry["cpu_seconds"] = round(cpu() - cpu_start, 4)
+        entry["process_peak_rss_bytes"] = peak_rss_bytes()
+
+
+def write_outputs(outdir: Path, tables, formats, stages=None, side_tables=(), serial=False):
+    """Write ``(name, rows, headers)`` tables in each requested format, one thread per format.
+
+    The writers spend much of their time in zlib, SQLite and file I/O, which release
+    the GIL, so formats overlap. Each format is timed in ``stages`` with its own
+    thread's CPU time; ``write`` covers them all. ``side_tables`` are CSV-only
+    extras (e.g. the --dq-detail log) written on their own thread as ``write_side``.
+    ``serial=True`` runs the writers one after another on the calling thread, which
+    is what --profile uses so the run's profiler sees them.
+    """
+    stages = {} if stages is None else stages
+    rows = sum(len(t[1]) for t in tables)
+
+    def each_table(writer, ext, tables=tables):
+        def write():
+            for name, table_rows, headers in tables:
+                writer(outdir / f"{name}.{ext}", table_rows, headers)
+
+        return write
+
+    writers = {
+        "csv": (each_table(write_csv, "csv"), [f"{t[0]}.csv" for t in tables]),
+        "xlsx": (lambda: write_multi_sheet_xlsx(outdir / "vp_dashboard_data.xlsx", tables), ["vp_dashboard_data.xlsx"]),
+        "parquet": (each_table(write_parquet, "parquet"), [f"{t[0]}.parquet" for t in tables]),
+        "sqlite": (lambda: write_sqlite(outdir / "vp_dashboard_data.sqlite", tables), ["vp_dashboard_data.sqlite"]),
+        "side": (each_table(write_csv, "csv", side_tables), [f"{t[0]}.csv" for t in side_tables]),
+    }
+
+    def run(fmt):
+        write, names = writers[fmt]
+        with timed(stages, f"write_{fmt}", rows, cpu=time.thread_time) as st:
+            write()
+        st["output_bytes"] = {n: (outdir / n).stat().st_size for n in names}
+
+    selected = [f for f in OUTPUT_FORMATS if f in formats] + (["side"] if side_tables else [])
+    with timed(stages, "write", rows):
+        if serial:
+            for fmt in selected:
+                run(fmt)
+        else:
+            with ThreadPoolExecutor(max_workers=len(selected)) as pool:
+                list(pool.map(run, selected))
+    return stages
+
+
+# Outputs are written into a staging directory inside --outdir, checksummed, and then
+# renamed into place: every file is replaced atomically (a reader never sees a partial
+# file), build_summary.json follows the data files and MANIFEST_FILE goes last, so a
+# consumer that checks the manifest can tell a complete set from one mid-publish.
+MANIFEST_FILE = "output_manifest.json"
+
+
+def output_manifest(staging: Path, names):
+    return {n: {"bytes": (staging / n).stat().st_size, "sha1": file_sha1(staging / n)} for n in names}
+
+
+def publish_outputs(staging: Path, outdir: Path, names):
+    """Move staged ``names`` into ``outdir`` in order with ``os.replace``.
+
+    Files the previous manifest listed that this build no longer produces (say, delta
+    files after a build without --delta) are removed once the new manifest is in place.
+    """
+    previous = outdir / MANIFEST_FILE
+    stale = set(json.loads(previous.read_text(encoding="utf-8")).get("files", {})) if previous.exists() else set()
+    for n in names:
+        os.replace(staging / n, outdir / n)
+    for n in stale - set(names):
+        (outdir / n).unlink(missing_ok=True)
+
+
+# Delta outputs (--delta). Each KPI and loan detail row is hashed over its CSV fields
+# and the hashes are published as <table>_row_hashes.csv. The next --delta run diffs
+# against them by DELTA_KEYS and writes <table>_inserted/_updated.csv (full rows) and
+# <table>_deleted.csv (keys only). The summary's delta.base_fingerprint names the run
+# the changes apply on top of: consumers that hold that run apply the deltas, anyone
+# else reloads the full files.
+DELTA_KEYS = {
+    "vp_kpi_monthly": ["report_month", "vp"],
+    "vp_loan_detail": ["loan_number", "vp", "report_month"],
+}
+DELTA_CHANGES = ["inserted", "updated", "deleted"]
+
+
+def delta_table_names():
+    return [f"{t}_{kind}" for t in DELTA_KEYS for kind in ["row_hashes", *DELTA_CHANGES]]
+
+
+def row_hash(fields):
+    return hashlib.sha1("\x1f".join(fields).encode("utf-8")).hexdigest()
+
+
+def load_row_hashes(path: Path, keys):
+    """``{key fields: row_hash}`` from a published row-hash file."""
+    with path.open(newline="", encoding="utf-8") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        idx = [header.index(k) for k in keys]
+        h = header.index("row_hash")
+        return {tuple(rec[i] for i in idx): rec[h] for rec in reader}
+
+
+def hash_rows(hashes, keys):
+    for key, h in hashes.items():
+        row = dict(zip(keys, key))
+        row["row_hash"] = h
+        yield row
+
+
+def diff_table(rows, headers, keys, prior):
+    """Hash ``rows`` and classify them against ``prior`` (consumed).
+
+    Returns the new ``{key: hash}`` map, inserted/updated flags per row position (for
+    ``itertools.compress``, so changed rows are not copied) and the deleted keys.
+    """
+    key_idx = [headers.index(k) for k in keys]
+    hashes = {}
+    inserted = bytearray()
+    updated = bytearray()
+    for r in rows:
+        fields = [csv_value(v) for v in map(r.get, headers)]
+        key = tuple(fields[i] for i in key_idx)
+        h = hashes[key] = row_hash(fields)
+        old = prior.pop(key, None)
+        inserted.append(old is None)
+        updated.append(old is not None and old != h)
+    return hashes, inserted, updated, list(prior)
+
+
+def build_deltas(outdir: Path, tables):
+    """Delta and row-hash side tables for the ``DELTA_KEYS`` tables, and their stats.
+
+    The previous hashes are used only if the published manifest lists them, i.e. the
+    last build into ``outdir`` wrote them; otherwise every row counts as inserted.
+    """
+    manifest_path = outdir / MANIFEST_FILE
+    prior_files = {}
+    base = None
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text(encoding="utf-8"))
+        prior_files = manifest.get("files", {})
+        base = manifest.get("run_fingerprint")
+    side_tables = []
+    stats = {"base_fingerprint": None}
+    for name, rows, headers in tables:
+        keys = DELTA_KEYS.get(name)
+        if keys is None:
+            continue
+        hash_file = f"{name}_row_hashes.csv"
+        prior = {}
+        if hash_file in prior_files and (outdir / hash_file).exists():
+            prior = load_row_hashes(outdir / hash_file, keys)
+            stats["base_fingerprint"] = base
+        hashes, inserted, updated, deleted = diff_table(rows, headers, keys, prior)
+        side_tables += [
+            (
+                f"{name}_row_hashes",
+                LazyRows(lambda h=hashes, k=keys: hash_rows(h, k), len(hashes)),
+                keys + ["row_hash"],
+            ),
+            (f"{name}_inserted", LazyRows(lambda r=rows, f=inserted: itertools.compress(r, f), sum(inserted)), headers),
+            (f"{name}_updated", LazyRows(lambda r=rows, f=updated: itertools.compress(r, f), sum(updated)), headers),
+            (f"{name}_deleted", [dict(zip(keys, k)) for k in deleted], keys),
+        ]
+        stats[name] = {"inserted": sum(inserted), "updated": sum(updated), "deleted": len(deleted)}
+    return side_tables, stats
+
+
+# Month-partitioned archive (--archive DIR). Each report_month of a build is kept in
+# DIR/report_month=<month>.<content>/ as gzip CSVs of ARCHIVE_TABLES, and
+# DIR/archive_index.json lists every partition with its directory, row counts, file
+# checksums and the build that wrote it. A build rewrites only the months it contains
+# whose rows changed; months it does not contain are left alone, so history from older
+# workbooks accumulates. A changed month goes to a new versioned directory, the index is
+# switched to it with os.replace and only then is the old directory removed, so the
+# index only ever names complete partitions. A reader still holding the previous index
+# can find its directory gone after the switch and should reload the index.
+ARCHIVE_INDEX = "archive_index.json"
+ARCHIVE_TABLES = ["vp_kpi_monthly", "vp_loan_detail"]
+
+
+def partition_dir(month, content):
+    return f"report_month={month}.{content[:12]}"
+
+
+def load_archive_index(archive: Path):
+    path = archive / ARCHIVE_INDEX
+    return json.loads(path.read_text(encoding="utf-8")) if path.exists() else {"partitions": {}}
+
+
+def write_archive_index(archive: Path, index):
+    tmp = archive / f".{ARCHIVE_INDEX}.tmp"
+    tmp.write_text(json.dumps(index, indent=2, sort_keys=True), encoding="utf-8")
+    os.replace(tmp, archive / ARCHIVE_INDEX)
+
+
+def iter_csv_records(fh):
+    """Raw records of a CSV file opened in binary mode; quoted line breaks stay inside a record."""
+    record = None
+    for line in fh:
+        record = line if record is None else record + line
+        if record.count(b'"') % 2 == 0:
+            yield record
+            record = None
+
+
+def archive_tables(archive: Path, staging: Path, tables, run_fingerprint, source_file):
+    """Upsert this build's report months into ``archive``; returns what was written.
+
+    Partitions are cut from the CSVs staged for this build (written into ``staging``
+    first when the build has no csv format), so archived rows are byte-for-byte the
+    published ones. A first pass hashes each month's records; only months whose hash
+    differs from the index are read again and gzipped into new partitions.
+    Directories the index no longer names (replaced versions, leftovers of an
+    interrupted run) are removed at the end.
+    """
+    archive.mkdir(parents=True, exist_ok=True)
+    index = load_archive_index(archive)
+    parts = index["partitions"]
+    sources = {}
+    for name, rows, headers in tables:
+        if name in ARCHIVE_TABLES:
+            sources[name] = staging / f"{name}.csv"
+            if not sources[name].exists():
+                write_csv(sources[name], rows, headers)
+
+    months = {}  # month -> [content sha1, {table: rows}]
+    for name, path in sources.items():
+        with path.open("rb") as fh:
+            header = next(fh)
+            for rec in iter_csv_records(fh):
+                m = rec[: rec.find(b",")].decode("utf-8")
+                p = months.get(m)
+                if p is None:
+                    p = months[m] = [hashlib.sha1(), {}]
+                if name not in p[1]:
+                    p[1][name] = 0
+                    p[0].update(name.encode("utf-8") + b"\n" + header)
+                p[0].update(rec)
+                p[1][name] += 1
+    changed = {m: p[0].hexdigest() for m, p in months.items()}
+    changed = {m: h for m, h in changed.items() if parts.get(m, {}).get("content_sha1") != h}
+
+    work = Path(tempfile.mkdtemp(prefix=".staging-", dir=archive))
+    try:
+        for name, path in sources.items():
+            open_files = {}
+            try:
+                with path.open("rb") as fh:
+                    header = next(fh)
+                    for rec in iter_csv_records(fh):
+                        m = rec[: rec.find(b",")].decode("utf-8")
+                        if m not in changed:
+                            continue
+                        out = open_files.get(m)
+                        if out is None:
+                            d = work / partition_dir(m, changed[m])
+                            d.mkdir(exist_ok=True)
+                            out = open_files[m] = gzip.open(d / f"{name}.csv.gz", "wb", compresslevel=6)
+                            out.write(header)
+                        out.write(rec)
+            finally:
+                for out in open_files.values():
+                    out.close()
+
+        updated_at = dt.datetime.now().replace(microsecond=0).isoformat(sep=" ")
+        for m, content in sorted(changed.items()):
+            counts = months[m][1]
+            name = partition_dir(m, content)
+            final = archive / name
+            if final.exists():  # not indexed (the content differs): left by an interrupted run
+                shutil.rmtree(final)
+            os.rename(work / name, final)
+            old = parts.get(m, {}).get("path")
+            parts[m] = {
+                "path": name,
+                "rows": counts,
+                "files": output_manifest(final, [f"{t}.csv.gz" for t in counts]),
+                "content_sha1": content,
+                "run_fingerprint": run_fingerprint,
+                "source_file": source_file,
+                "updated_at": updated_at,
+            }
+            write_archive_index(archive, index)
+            if old is not None:
+                shutil.rmtree(archive / old, ignore_errors=True)
+        if not (archive / ARCHIVE_INDEX).exists():
+            write_archive_index(archive, index)
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    live = {v["path"] for v in parts.values()}
+    for d in archive.glob("report_month=*"):
+        if d.name not in live:
+            shutil.rmtree(d, ignore_errors=True)
+    return {
+        "path": str(archive),
+        "partitions": len(parts),
+        "months_in_build": len(months),
+        "months_written": sorted(changed),
+    }
+
+
+def iter_archive_rows(archive: Path, table, start=None, end=None):
+    """Yield the header, then the CSV rows of ``table`` for index months in ``[start, end]``.
+
+    Only the partitions in range are opened. Partitions written by builds with other
+    optional columns (say, --leaderboard ranks) are lined up under the union of their
+    headers, with missing columns left empty.
+    """
+    if table not in ARCHIVE_TABLES:
+        raise SystemExit(f"Archived tables: {', '.join(ARCHIVE_TABLES)}")
+    parts = load_archive_index(archive)["partitions"]
+    paths = [
+        archive / parts[m]["path"] / f"{table}.csv.gz"
+        for m in sorted(parts)
+        if not ((start and m < start) or (end and m > end)) and table in parts[m]["rows"]
     ]
+    heads = []
+    for path in paths:
+        with gzip.open(path, "rt", newline="", encoding="utf-8") as fh:
+            heads.append(next(csv.reader(fh)))
+    header = list(dict.fromkeys(h for head in heads for h in head))
+    yield header
+    for path, head in zip(paths, heads):
+        with gzip.open(path, "rt", newline="", encoding="utf-8") as fh:
+            reader = csv.reader(fh)
+            next(reader)
+            if head == header:
+                yield from reader
+            else:
+                pos = {h: i for i, h in enumerate(head)}
+                pick_cols = [pos.get(h) for h in header]
+                yield from ([rec[i] if i is not None else "" for i in pick_cols] for rec in reader)
+
+
+def archive_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="build_vp_dashboard_data.py archive", description="Read a table back from a --archive directory."
+    )
+    parser.add_argument("--archive", type=str, default="output/archive", help="Archive directory.")
+    parser.add_argument("--table", choices=ARCHIVE_TABLES, default="vp_kpi_monthly", help="Table to read.")
+    parser.add_argument("--from", dest="start", type=str, default=None, help="First report_month (inclusive).")
+    parser.add_argument("--to", dest="end", type=str, default=None, help="Last report_month (inclusive).")
+    parser.add_argument("--out", type=str, default=None, help="CSV file to write. Default: stdout.")
+    args = parser.parse_args(argv)
+    root = Path(__file__).resolve().parents[1]
+    archive = (root / args.archive).resolve()
+    if not (archive / ARCHIVE_INDEX).exists():
+        raise SystemExit(f"No {ARCHIVE_INDEX} in {archive}; run a build with --archive first.")
+    rows = iter_archive_rows(archive, args.table, args.start, args.end)
+    if args.out:
+        with (root / args.out).open("w", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerows(rows)
+    else:
+        csv.writer(sys.stdout).writerows(rows)
+
+
+def read_source(source: Path, source_name=None):
+    base = cache_counts()
+    clock = time.perf_counter
+    start = clock()
+    with open_source_rows(source) as it:
+        sst = clock() - start
+        headers = next(it)
+        acc = BuildAccumulator(resolve_columns(headers), source_name)
+        add_row = acc.add_row
+        dedupe = 0.0
+        for source_row, row in enumerate(it, start=2):
+            t = clock()
+            add_row(row, source_row)
+            dedupe += clock() - t
+    acc.cache_counts = cache_counts_since(base)
+    # rows stream from the parser into add_row, so parse time is what add_row did not use;
+    # shared_strings is the time to open the source (near zero for delimited text)
+    acc.timings = {"shared_strings": sst, "sheet_parse": clock() - start - sst - dedupe, "dedupe": dedupe}
+    return acc
+
+
+NUMPY_BATCH_ROWS = 16384
+# vp_loan_detail dimension -> the coerced column it comes from
+NUMPY_DIM_FIELDS = {
+    "fund_date": "fund_date",
+    "state": "state",
+    "product_bucket_group": "product",
+    "purpose": "purpose",
+    "loan_amount": "loan_amount",
+}
+NUMPY_CODED_FIELDS = {"loan", "vp", "bom", "comp_bucket", *NUMPY_DIM_FIELDS.values()}
+NEGATIVE_ZERO = object()  # code table key for -0.0, which would otherwise share 0.0's code
+
 
-    write_csv(outdir / "vp_kpi_monthly.csv", monthly_rows, kpi_headers)
-    write_csv(outdir / "vp_loan_detail.csv", loan_rows, loan_headers)
-    write_csv(outdir / "vp_exception_log.csv", exception_rows, exception_headers)
-
-    write_multi_sheet_xlsx(
-        outdir / "vp_dashboard_data.xlsx",
-        [
-            ("vp_kpi_monthly", monthly_rows, kpi_headers),
-            ("vp_loan_detail", loan_rows, loan_headers),
-            ("vp_exception_log", exception_rows, exception_headers),
-        ],
+def require_numpy():
+    try:
+        import numpy as np
+    except ImportError:
+        raise SystemExit("--engine numpy needs numpy: pip install numpy")
+    return np
+
+
+def read_source_numpy(source: Path):
+    """``read_source`` for one source with the per-row work done column-wise in NumPy.
+
+    Rows are pulled in batches of ``NUMPY_BATCH_ROWS`` and transposed. Amounts become
+    float64 columns with NaN as null; keys, text, dates and loan amounts are converted
+    once per distinct cell into codes of a per-column value table. After the read,
+    ``(bom, vp)`` and ``(loan, vp, bom)`` keys are grouped with ``np.unique``.
+    Event sums use ``np.bincount``, which adds in row order, so the floats match the
+    Python loop's; HC and loan numerics take ``np.fmax`` per key, keeping the first
+    zero where ``max`` would pick between 0.0 and -0.0; each dimension takes the key's
+    first non-null value, and every later non-null value that compares unequal is a
+    conflict. Cells that convert to NaN, which ``max`` and ``!=`` treat in ways a
+    vectorized group-by does not reproduce, send the source back to ``read_source``.
+    Converter cache counts cover the distinct coded cells per batch; amounts skip
+    the cache.
+    """
+    np = require_numpy()
+    base = cache_counts()
+    clock = time.perf_counter
+    start = clock()
+    tables = {f: {} for f in NUMPY_CODED_FIELDS}  # converted value -> code
+    parts = defaultdict(list)
+    exact = True
+    dedupe = 0.0
+
+    def code(f, v):
+        nonlocal exact
+        if f == "vp":
+            v = v or "(Unknown VP)"
+        elif f == "bom":
+            v = v or "unknown"
+        elif type(v) is float:
+            if v != v:
+                exact = False
+            elif v == 0.0 and math.copysign(1.0, v) < 0:
+                v = NEGATIVE_ZERO
+        table = tables[f]
+        return table.setdefault(v, len(table))
+
+    with open_source_rows(source) as it:
+        sst = clock() - start
+        headers = next(it)
+        c = resolve_columns(headers)
+        acc = BuildAccumulator(c)
+        while exact:
+            batch = list(itertools.islice(it, NUMPY_BATCH_ROWS))
+            if not batch:
+                break
+            t = clock()
+            n = len(batch)
+            cols = list(zip(*batch))
+            del batch
+            for f, kind in COLUMN_KINDS.items():
+                col = cols[c[f]] if c[f] is not None else (None,) * n
+                if f in NUMPY_CODED_FIELDS:
+                    # keys, labels and dimensions: convert each distinct cell once
+                    conv = CONVERTERS[kind]
+                    distinct = dict.fromkeys(col)
+                    for raw in distinct:
+                        distinct[raw] = code(f, conv(raw))
+                    parts[f].append(np.fromiter(map(distinct.__getitem__, col), dtype=np.int32, count=n))
+                else:
+                    # amounts are mostly distinct, so the converter runs per cell
+                    vals = list(map(to_num, col))
+                    a = np.array(vals, dtype=float)
+                    exact = exact and np.count_nonzero(np.isnan(a)) == vals.count(None)
+                    parts[f].append(a)
+            del cols  # the cell strings of one batch are the bulk of the engine's memory
+            acc.raw_rows += n
+            dedupe += clock() - t
+    if not exact:
+        return read_source(source)
+    parse = clock() - start - sst - dedupe
+    t = clock()
+    if acc.raw_rows:
+        aggregate_numpy_columns(np, acc, {f: np.concatenate(parts.pop(f)) for f in list(parts)}, tables)
+    acc.cache_counts = cache_counts_since(base)
+    acc.timings = {"shared_strings": sst, "sheet_parse": parse, "dedupe": dedupe + clock() - t}
+    return acc
+
+
+def aggregate_numpy_columns(np, acc, col, tables):
+    """Fill ``acc`` from the coerced columns of ``read_source_numpy`` (see there)."""
+    # code -> converted value, and code -> code of the first value that compares equal to it
+    values = {f: [-0.0 if v is NEGATIVE_ZERO else v for v in table] for f, table in tables.items()}
+    same = {}
+    for f, vals in values.items():
+        canon = {}
+        same[f] = np.array([canon.setdefault(v, c) for c, v in enumerate(vals)], dtype=np.int64)
+    n_vp, n_bom = len(values["vp"]), len(values["bom"])
+
+    def groups(keys):
+        """Distinct keys, each key's first row, row -> key, rows sorted by key (stably) and group starts."""
+        uniq, first, inv = np.unique(keys, return_index=True, return_inverse=True)
+        inv = inv.reshape(-1)
+        order = np.argsort(inv, kind="stable")
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(inv[order])) + 1))
+        return uniq, first, inv, order, starts
+
+    def max_per_key(a, order, starts):
+        a = a[order]
+        top = np.fmax.reduceat(a, starts)
+        # max() keeps the first of equal values, which only shows between 0.0 and -0.0
+        zero = a == 0
+        if zero.any():
+            first_zero = np.minimum.reduceat(np.where(zero, np.arange(len(a)), len(a)), starts)
+            at_zero = top == 0
+            top[at_zero] = a[first_zero[at_zero]]
+        return [None if x != x else x for x in top.tolist()]
+
+    # (bom, vp): event sums, "No Loan #" rows and HC maxima
+    month_keys, first, inv, order, starts = groups(col["bom"].astype(np.int64) * n_vp + col["vp"])
+    ev_fields = EVENT_COST_FIELDS + BONUS_FIELDS
+    sums = [
+        np.bincount(inv, weights=np.where(np.isnan(col[f]), 0.0, col[f]), minlength=len(month_keys)).tolist()
+        for f in ev_fields
+    ]
+    no_loan = tables["comp_bucket"].get("No Loan #")
+    no_loan_rows = (
+        np.bincount(inv, weights=col["comp_bucket"] == no_loan, minlength=len(month_keys)).tolist()
+        if no_loan is not None
+        else [0.0] * len(month_keys)
+    )
+    hc_sales = max_per_key(col["active_sales_hc"], order, starts)
+    hc_non = max_per_key(col["active_non_hc"], order, starts)
+    month_keys = month_keys.tolist()
+    for k in np.argsort(first, kind="stable").tolist():
+        key = (values["bom"][month_keys[k] // n_vp], values["vp"][month_keys[k] % n_vp])
+        ev = acc.event_monthly[key]
+        for f, total in zip(ev_fields, sums):
+            ev[f] = total[k]
+        if no_loan_rows[k]:
+            ev["no_loan_bucket_rows"] = no_loan_rows[k]
+        acc.hc_monthly[key] = {"active_sales_hc": hc_sales[k], "active_non_producing_sales_hc": hc_non[k]}
+
+    # (loan, vp, bom): row counts, numeric maxima, first non-null dimensions and conflicts
+    rows = np.flatnonzero(np.array([bool(v) for v in values["loan"]], dtype=bool)[col["loan"]])
+    if not len(rows):
+        return
+    _, first, inv, order, starts = groups(
+        (col["loan"][rows].astype(np.int64) * n_bom + col["bom"][rows]) * n_vp + col["vp"][rows]
     )
+    counts = np.diff(np.append(starts, len(rows))).tolist()
+    nums = {f: max_per_key(col[f][rows], order, starts) for f in REV_FIELDS + EXP_LOAN_FIELDS}
+    dims = {}
+    conflicts = []  # (row position, dimension position, key, code) arrays per dimension
+    never = len(rows)
+    for i, (dim, f) in enumerate(NUMPY_DIM_FIELDS.items()):
+        codes = col[f][rows]
+        null = tables[f].get(None)
+        present = codes != null if null is not None else np.ones(len(rows), dtype=bool)
+        first_pos = np.minimum.reduceat(np.where(present[order], np.arange(len(rows)), never), starts)
+        first_code = np.where(first_pos < never, codes[order][np.minimum(first_pos, never - 1)], -1)
+        dims[dim] = [values[f][c] if c >= 0 else None for c in first_code.tolist()]
+        equal = same[f][codes] == np.where(first_code >= 0, same[f][first_code], -1)[inv]
+        hit = np.flatnonzero(present & ~equal)
+        conflicts.append((hit, np.full(len(hit), i), inv[hit], codes[hit]))
+    first_rows = rows[first]
+    loan_col, vp_col, bom_col = (col[f][first_rows].tolist() for f in ("loan", "vp", "bom"))
+    first_rows = (first_rows + 2).tolist()
+    for k in np.argsort(first, kind="stable").tolist():
+        loan, vp, bom = values["loan"][loan_col[k]], values["vp"][vp_col[k]], values["bom"][bom_col[k]]
+        acc.loan_level[(loan, vp, bom)] = LoanRecord(
+            loan,
+            vp,
+            bom,
+            {d: dims[d][k] for d in LOAN_DIMS},
+            {f: nums[f][k] for f in REV_FIELDS + EXP_LOAN_FIELDS},
+            counts[k],
+            first_rows[k],
+        )
+
+    hit, dim_pos, keys, codes = (np.concatenate(a) for a in zip(*conflicts))
+    sort = np.lexsort((dim_pos, hit))  # source order, then LOAN_DIMS order within a row
+    dim_names = list(NUMPY_DIM_FIELDS.items())
+    for source_row, i, k, c in zip(*(a[sort].tolist() for a in (rows[hit] + 2, dim_pos, keys, codes))):
+        dim, f = dim_names[i]
+        acc.dq_issues.append(
+            {
+                "issue_type": f"inconsistent_{dim}",
+                "issue_key": f"{values['loan'][loan_col[k]]}|{values['vp'][vp_col[k]]}|{values['bom'][bom_col[k]]}",
+                "dim": dim,
+                "cur": dims[dim][k],
+                "new": values[f][c],
+                "source_row": source_row,
+                "source": None,
+            }
+        )
+
+
+def read_sources(sources, workers=None):
+    """Aggregate several workbooks in a process pool and merge them in the given order.
+
+    Each worker returns a ``BuildAccumulator`` for one workbook; ``BuildAccumulator.merge``
+    then applies max for HC and loan numerics, sums for event costs and first-non-null
+    dimensions (logging conflicts) across workbooks, so "first" means the earliest file.
+    """
+    if len(sources) == 1:
+        return read_source(sources[0])
+    workers = min(workers or os.cpu_count() or 1, len(sources))
+    names = [p.name for p in sources]
+    if workers == 1:
+        parts = map(read_source, sources, names)
+        pool = None
+    else:
+        pool = ProcessPoolExecutor(max_workers=workers)
+        parts = pool.map(read_source, sources, names)
+    try:
+        acc = None
+        for part in parts:
+            if acc is None:
+                acc = part
+            else:
+                acc.merge(part)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return acc
+
+
+def expand_sources(args):
+    """Resolve ``--source`` values; glob patterns skip "preliminary" files like auto-detection does."""
+    out = []
+    for a in args:
+        if glob.has_magic(a):
+            matches = [Path(m) for m in sorted(glob.glob(a))]
+            out.extend(p.resolve() for p in matches if p.is_file() and "preliminary" not in p.name.lower())
+        else:
+            out.append(Path(a).resolve())
+    return list(dict.fromkeys(out))
+
+
+# Preview builds (--sample / --sample-loans). Every sampling unit gets a 64-bit hash: a
+# loan row hashes its (loan, vp, bom) key, so all rows of a kept key are read and the
+# dedupe sees the same duplicates as a full build, and a row without a loan number
+# (event/HC rows) hashes its (bom, vp) with its ordinal among such rows of that
+# VP-month. A unit is kept when its hash falls under fraction * 2**64, so the same
+# source always yields the same sample and each VP-month keeps about that share of its
+# rows. --sample-loans N keeps the N smallest loan-key hashes, which sets the threshold.
+SAMPLE_HASH_SPACE = 1 << 64
+SAMPLE_KEY_FIELDS = ("loan", "vp", "bom")
+# vp_kpi_monthly columns multiplied by 1 / sampled share with --sample-scale; ratios
+# other than productivity (revenue over unsampled HC) are unchanged by the scaling
+SAMPLE_SCALED_COLUMNS = [
+    "loan_count",
+    "loan_volume",
+    "total_revenue",
+    "total_expense",
+    "contribution_margin",
+    "productivity",
+    "bonus_spend_proxy",
+    "event_compensafe_amt",
+    "event_rent_amt",
+    "event_payroll_amt",
+    "event_no_loan_bucket_rows",
+]
+
+
+def sample_hash(text):
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def read_source_sampled(source: Path, fraction=None, loans=None, source_name=None):
+    """Read ``source`` once and aggregate only the sampled units (see above).
+
+    With ``loans`` the rows of candidate keys are held until the sheet ends, since a
+    later key with a smaller hash can push one out; the kept rows are then added in
+    source order. ``acc.sample`` records the share that was kept and the row counts.
+    """
+    base = cache_counts()
+    clock = time.perf_counter
+    start = clock()
+    with open_source_rows(source) as it:
+        sst = clock() - start
+        headers = next(it)
+        c = resolve_columns(headers)
+        acc = BuildAccumulator(c, source_name)
+        key_plan = [(f, conv, idx) for f, conv, idx in acc.plan if f in SAMPLE_KEY_FIELDS]
+        threshold = int(fraction * SAMPLE_HASH_SPACE) if fraction is not None else SAMPLE_HASH_SPACE
+        event_ordinal = defaultdict(int)
+        smallest = []  # loans: max-heap (negated) of the N smallest loan-key hashes
+        pending = {}  # loans: candidate key -> [hash, (source_row, row), ...]
+        event_rows = []  # loans: (hash, source_row, row) of candidate event/HC rows
+        event_limit = 1024
+        sampling = dedupe = 0.0
+        rows_read = 0
+        for source_row, row in enumerate(it, start=2):
+            t = clock()
+            rows_read += 1
+            v = dict.fromkeys(SAMPLE_KEY_FIELDS)
+            for f, conv, idx in key_plan:
+                v[f] = conv(row[idx])
+            vp, bom = v["vp"] or "(Unknown VP)", v["bom"] or "unknown"
+            if v["loan"]:
+                key = f"{v['loan']}\x1f{vp}\x1f{bom}"
+                h = sample_hash(key)
+            else:
+                n = event_ordinal[(bom, vp)] = event_ordinal[(bom, vp)] + 1
+                key = None
+                h = sample_hash(f"{bom}\x1f{vp}\x1f{n}")
+            if h > threshold:
+                sampling += clock() - t
+                continue
+            if loans is None:
+                t2 = clock()
+                sampling += t2 - t
+                acc.add_row(row, source_row)
+                dedupe += clock() - t2
+                continue
+            if key is None:
+                event_rows.append((h, source_row, row))
+            elif key in pending:
+                pending[key].append((source_row, row))
+            else:
+                pending[key] = [h, (source_row, row)]
+                heapq.heappush(smallest, (-h, key))
+                if len(smallest) > loans:
+                    _, dropped = heapq.heappop(smallest)
+                    del pending[dropped]
+                    threshold = -smallest[0][0]
+                    if len(event_rows) > event_limit:
+                        event_rows = [e for e in event_rows if e[0] <= threshold]
+                        event_limit = max(1024, 2 * len(event_rows))
+            sampling += clock() - t
+
+    if loans is not None:
+        t = clock()
+        kept = [(r, row) for rows in pending.values() for r, row in rows[1:]]
+        kept += [(r, row) for h, r, row in event_rows if h <= threshold]
+        kept.sort(key=itemgetter(0))
+        for source_row, row in kept:
+            acc.add_row(row, source_row)
+        dedupe += clock() - t
+    acc.cache_counts = cache_counts_since(base)
+    acc.timings = {
+        "shared_strings": sst,
+        "sheet_parse": clock() - start - sst - sampling - dedupe,
+        "sampling": sampling,
+        "dedupe": dedupe,
+    }
+    share = threshold / SAMPLE_HASH_SPACE
+    acc.sample = {
+        "fraction": fraction,
+        "loans": loans,
+        "share": share,
+        "scale": 1 / share if share else None,
+        "rows_read": rows_read,
+        "rows_kept": acc.raw_rows,
+        "loan_keys_kept": len(acc.loan_level),
+    }
+    return acc
+
+
+# Sharded single-sheet parsing (--shards). The decompressed sheet is split into byte
+# ranges on <row> boundaries and each range is parsed and pre-aggregated in a worker
+# process. Event sums travel as their ordered terms (SumLog) and repeated loan keys as
+# their per-row dimension values, so merge_shards can replay exactly what the serial
+# loop computes, including which dedupe conflicts are logged and in what order.
+
+
+class SumLog(array):
+    """A float sum kept as its ordered non-zero terms; ``total()`` adds them left to right."""
+
+    def __new__(cls, values=()):
+        return super().__new__(cls, "d", values)
+
+    def __iadd__(self, v):
+        if v:
+            self.append(v)
+        return self
+
+    def total(self):
+        t = 0.0
+        for v in self:
+            t += v
+        return t
 
-    summary = {
-        "source_file": str(source),
-        "generated_at": dt.datetime.now().replace(microsecond=0).isoformat(sep=" "),
-        "raw_rows_read": raw_rows,
-        "vp_month_rows": len(monthly_rows),
-        "loan_detail_rows": len(loan_rows),
-        "exception_rows": len(exception_rows),
-        "output_files": [
-            str(outdir / "vp_kpi_monthly.csv"),
-            str(outdir / "vp_loan_detail.csv"),
-            str(outdir / "vp_exception_log.csv"),
-            str(outdir / "vp_dashboard_data.xlsx"),
-        ],
-        "run_fingerprint": hashlib.sha1(
-            (str(source) + "|" + str(raw_rows) + "|" + str(len(loan_rows)) + "|" + str(len(monthly_rows))).encode(
-                "utf-8"
+
+def new_event_log():
+    return defaultdict(SumLog)
+
+
+class ShardAccumulator(BuildAccumulator):
+    """``BuildAccumulator`` for one byte range of a sheet.
+
+    ``dims_log`` holds, for every loan key seen more than once in the shard, the
+    ``(source_row, dims)`` of each of its rows.
+    """
+
+    def __init__(self, c):
+        super().__init__(c)
+        self.event_monthly = defaultdict(new_event_log)
+        self.dims_log = {}
+
+
+def count_rows(mm, start, end):
+    n = 0
+    while start < end:
+        stop = min(start + READ_CHUNK, end)
+        if stop < end:
+            # never split a tag between windows
+            stop = mm.find(b"<", stop, end)
+            if stop < 0:
+                stop = end
+        n += mm[start:stop].count(b"<row")
+        start = stop
+    return n
+
+
+def shard_ranges(mm, shards):
+    """Split ``<sheetData>`` into up to ``shards`` ``(start, end, rows_before)`` ranges.
+
+    Returns ``(head, tail, ranges)``, where ``head``/``tail`` are the XML around the row
+    data that wrap each range into a well-formed document, or ``None`` when the sheet
+    does not use an unprefixed ``<sheetData>``.
+    """
+    open_tag = mm.find(b"<sheetData")
+    body_end = mm.rfind(b"</sheetData>")
+    if open_tag < 0 or body_end < 0:
+        return None
+    body_start = mm.find(b">", open_tag) + 1
+    cuts = [body_start]
+    for k in range(1, shards):
+        pos = mm.find(b"<row", body_start + (body_end - body_start) * k // shards, body_end)
+        if pos < 0:
+            break
+        if pos > cuts[-1]:
+            cuts.append(pos)
+    cuts.append(body_end)
+    ranges = []
+    rows_before = 0
+    for start, end in zip(cuts, cuts[1:]):
+        ranges.append((start, end, rows_before))
+        rows_before += count_rows(mm, start, end)
+    return mm[:body_start], mm[body_end:], ranges
+
+
+_shard_ctx = {}
+
+
+def init_shard_worker(sheet_file, head, tail, shared, c, width):
+    _shard_ctx.update(sheet_file=sheet_file, head=head, tail=tail, shared=shared, c=c, width=width)
+
+
+def parse_shard(start, end, rows_before):
+    ctx = _shard_ctx
+    base = cache_counts()
+    acc = ShardAccumulator(ctx["c"])
+    with open(ctx["sheet_file"], "rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+
+        def chunks():
+            yield ctx["head"]
+            for pos in range(start, end, READ_CHUNK):
+                yield mm[pos : min(pos + READ_CHUNK, end)]
+            yield ctx["tail"]
+
+        rows = iter_xml_rows(chunks(), ctx["shared"], ctx["width"])
+        if rows_before == 0:
+            next(rows, None)  # header row
+            rows_before = 1
+        for source_row, row in enumerate(rows, start=rows_before + 1):
+            acc.add_row(row, source_row)
+    acc.cache_counts = cache_counts_since(base)
+    return acc
+
+
+def merge_shards(parts, c):
+    """Fold shard accumulators, in sheet order, into the serial loop's result."""
+    acc = BuildAccumulator(c)
+    events = defaultdict(new_event_log)
+    for part in parts:
+        acc.raw_rows += part.raw_rows
+        acc.cache_counts = add_cache_counts(acc.cache_counts, part.cache_counts)
+        for key, hc in part.hc_monthly.items():
+            mine = acc.hc_monthly[key]
+            for f, v in hc.items():
+                mine[f] = merge_max(mine[f], v)
+        for key, ev in part.event_monthly.items():
+            mine = events[key]
+            for f, terms in ev.items():
+                mine[f].extend(terms)
+        replayed = set()
+        for lkey, incoming in part.loan_level.items():
+            entry = acc.loan_level.get(lkey)
+            if entry is None:
+                acc.loan_level[lkey] = incoming
+                continue
+            # key seen in an earlier shard: replay this shard's rows against the merged entry
+            replayed.add("|".join(lkey))
+            entry["row_count"] += incoming["row_count"]
+            for source_row, dims in part.dims_log.get(lkey) or [(incoming["first_source_row"], incoming)]:
+                acc.merge_loan(entry, dims, incoming, source_row, None)
+        acc.dq_issues.extend(d for d in part.dq_issues if d["issue_key"] not in replayed)
+    for key, ev in events.items():
+        acc.event_monthly[key].update((f, terms.total()) for f, terms in ev.items())
+    # sort is stable, so issues raised by the same row keep their dimension order
+    acc.dq_issues.sort(key=lambda d: d["source_row"])
+    return acc
+
+
+def read_source_sharded(source: Path, shards, workers=None):
+    with zipfile.ZipFile(source) as zf:
+        shared = parse_shared_strings(zf)
+        sheet = first_sheet_path(zf)
+        it = iter_sheet_rows(zf, sheet, shared)
+        headers = next(it)
+        it.close()
+        c = resolve_columns(headers)
+        with tempfile.TemporaryDirectory() as tmp:
+            sheet_file = Path(tmp) / "sheet.xml"
+            with zf.open(sheet) as src, sheet_file.open("wb") as dst:
+                shutil.copyfileobj(src, dst, READ_CHUNK)
+            with sheet_file.open("rb") as fh, mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                split = shard_ranges(mm, shards)
+            if split is None:
+                return read_source(source)
+            head, tail, ranges = split
+            init_args = (str(sheet_file), head, tail, shared, c, len(headers))
+            starts, ends, before = zip(*ranges)
+            workers = min(workers or os.cpu_count() or 1, len(ranges))
+            if workers == 1:
+                init_shard_worker(*init_args)
+                return merge_shards(map(parse_shard, starts, ends, before), c)
+            with ProcessPoolExecutor(workers, initializer=init_shard_worker, initargs=init_args) as pool:
+                return merge_shards(pool.map(parse_shard, starts, ends, before), c)
+
+
+# Bounded-memory dedupe (--max-memory). SpillAccumulator keeps loan entries, the
+# per-row dimension log of repeated keys and dq issues in RAM until their estimated
+# size passes the budget, then writes them out as a run sorted by loan key.
+# finish() merges the runs key by key (later rows are replayed against the earliest
+# entry, as in merge_shards), re-sorts loans and issues into source order through
+# budget-sized runs, and leaves views that stream the final merge on every pass.
+SPILL_CHECK_ROWS = 4096
+SIZE_UNITS = {"": 1, "K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+
+def parse_size(text):
+    m = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*", text.upper())
+    if not m:
+        raise argparse.ArgumentTypeError(f"expected a size like 512M or 2G, got {text!r}")
+    return int(float(m.group(1)) * SIZE_UNITS[m.group(2)])
+
+
+def approx_size(rec):
+    """Shallow size of a LoanRecord plus its values; the per-record estimate for the budget."""
+    return sys.getsizeof(rec) + sum(sys.getsizeof(getattr(rec, f)) for f in rec.__slots__)
+
+
+def write_run(path: Path, records):
+    with path.open("wb") as fh:
+        for rec in records:
+            pickle.dump(rec, fh, pickle.HIGHEST_PROTOCOL)
+    return path.stat().st_size
+
+
+def iter_run(path: Path):
+    with path.open("rb") as fh:
+        while True:
+            try:
+                yield pickle.load(fh)
+            except EOFError:
+                return
+
+
+def merge_runs(paths):
+    """Merge ``(sort key, ...)`` runs; ties keep run order."""
+    return heapq.merge(*map(iter_run, paths), key=itemgetter(0))
+
+
+class RunSorter:
+    """External sort of ``(key, value)`` pairs through runs of at most ``limit`` records."""
+
+    def __init__(self, directory: Path, prefix, limit):
+        self.directory = directory
+        self.prefix = prefix
+        self.limit = limit
+        self.buf = []
+        self.paths = []
+        self.n = 0
+        self.bytes = 0
+
+    def add(self, key, value):
+        self.buf.append((key, value))
+        if len(self.buf) >= self.limit:
+            self.flush()
+
+    def flush(self):
+        if not self.buf:
+            return
+        self.buf.sort(key=itemgetter(0))
+        path = self.directory / f"{self.prefix}_{len(self.paths):05d}.pkl"
+        self.bytes += write_run(path, self.buf)
+        self.paths.append(path)
+        self.n += len(self.buf)
+        self.buf = []
+
+    def rows(self):
+        self.flush()
+        paths = self.paths
+        return LazyRows(lambda: (value for _, value in merge_runs(paths)), self.n)
+
+
+class SpillAccumulator(ShardAccumulator):
+    """``BuildAccumulator`` for one in-process pass whose dedupe state spills past ``budget`` bytes."""
+
+    def __init__(self, c, budget, source_name=None):
+        super().__init__(c)
+        self.source_name = source_name
+        # sequential pass: plain float sums like BuildAccumulator, no per-term logs
+        self.event_monthly = defaultdict(new_event_entry)
+        self.budget = budget
+        self.tmp = tempfile.TemporaryDirectory(prefix="vp_spill_")
+        self.runs = []
+        self.spilled_bytes = 0
+        self.logged = 0
+        self.record_bytes = None
+
+    def add_row(self, row, source_row):
+        super().add_row(row, source_row)
+        if self.raw_rows % SPILL_CHECK_ROWS == 0 and self.loan_level:
+            if self.record_bytes is None:
+                self.record_bytes = approx_size(next(iter(self.loan_level.values())))
+            if (len(self.loan_level) + self.logged + len(self.dq_issues)) * self.record_bytes > self.budget:
+                self.spill()
+
+    def merge_loan(self, entry, dims, nums, source_row, source_name):
+        self.logged += 1
+        super().merge_loan(entry, dims, nums, source_row, source_name)
+
+    def spill(self):
+        issues = defaultdict(list)
+        for d in self.dq_issues:
+            issues[d["issue_key"]].append(d)
+        path = Path(self.tmp.name) / f"keys_{len(self.runs):05d}.pkl"
+        self.spilled_bytes += write_run(
+            path,
+            ((k, e, self.dims_log.get(k), issues.get("|".join(k))) for k, e in sorted(self.loan_level.items())),
+        )
+        self.runs.append(path)
+        self.loan_level = {}
+        self.dims_log = {}
+        self.dq_issues = []
+        self.logged = 0
+
+    def finish(self):
+        """Accumulator for ``build_tables``: plain if nothing spilled, else backed by sorted runs."""
+        acc = BuildAccumulator(None, self.source_name)
+        acc.raw_rows = self.raw_rows
+        acc.cache_counts = self.cache_counts
+        acc.event_monthly = self.event_monthly
+        acc.hc_monthly = self.hc_monthly
+        acc.spill = {"budget_bytes": self.budget, "key_runs": len(self.runs), "spilled_bytes": self.spilled_bytes}
+        if not self.runs:
+            acc.loan_level = self.loan_level
+            acc.dq_issues = self.dq_issues
+            self.tmp.cleanup()
+            return acc
+        self.spill()
+        tmp = Path(self.tmp.name)
+        limit = max(1, self.budget // (2 * self.record_bytes))
+        loans = RunSorter(tmp, "loans", limit)
+        issues = RunSorter(tmp, "issues", limit)
+        replay = BuildAccumulator(None, self.source_name)
+        for _, group in itertools.groupby(merge_runs(self.runs), key=itemgetter(0)):
+            _, entry, _, first_issues = next(group)
+            for _, incoming, log, _ in group:
+                entry["row_count"] += incoming["row_count"]
+                for source_row, dims in log or [(incoming["first_source_row"], incoming)]:
+                    replay.merge_loan(entry, dims, incoming, source_row, self.source_name)
+            for d in itertools.chain(first_issues or (), replay.dq_issues):
+                issues.add((d["source_row"], LOAN_DIMS.index(d["dim"])), d)
+            replay.dq_issues.clear()
+            loans.add(entry["first_source_row"], entry)
+        acc.loan_level = loans.rows()
+        acc.dq_issues = issues.rows()
+        for p in self.runs:
+            p.unlink()
+        acc.spill["key_runs"] = len(self.runs)
+        acc.spill["spilled_bytes"] += loans.bytes + issues.bytes
+        acc.spill_dir = self.tmp  # keeps the runs on disk until the outputs are written
+        return acc
+
+
+def read_source_spilling(source: Path, budget):
+    base = cache_counts()
+    with open_source_rows(source) as it:
+        headers = next(it)
+        acc = SpillAccumulator(resolve_columns(headers), budget)
+        for source_row, row in enumerate(it, start=2):
+            acc.add_row(row, source_row)
+    acc.cache_counts = cache_counts_since(base)
+    return acc.finish()
+
+
+# Incremental state store, under <outdir>/.build_state/:
+#   state.json                 source hash, header hash and {hash, file} per report_month
+#   month_<bom>_<hash>.json    that partition's BuildAccumulator content plus the
+#                              source rows (as runs) it was built from
+# A month is reused only when the ordered content hash of its source rows matches.
+# Rows of previously seen months are parked in a temp file while the sheet streams
+# and replayed through the accumulator only if that month turns out to have changed.
+
+STATE_VERSION = 1
+
+
+def row_runs(rows):
+    runs = []
+    for r in rows:
+        if runs and runs[-1][0] + runs[-1][1] == r:
+            runs[-1][1] += 1
+        else:
+            runs.append([r, 1])
+    return runs
+
+
+def expand_runs(runs):
+    out = []
+    for start, n in runs:
+        out.extend(range(start, start + n))
+    return out
+
+
+def partition_to_json(acc, rows):
+    return {
+        "rows": row_runs(rows),
+        "raw_rows": acc.raw_rows,
+        "loan_level": [[list(k), v.to_dict()] for k, v in acc.loan_level.items()],
+        "event_monthly": [[list(k), dict(v)] for k, v in acc.event_monthly.items()],
+        "hc_monthly": [[list(k), v] for k, v in acc.hc_monthly.items()],
+        "dq_issues": acc.dq_issues,
+    }
+
+
+def partition_from_json(data, c, row_map):
+    """Rebuild a stored partition, renumbering source rows with ``row_map`` (old -> new)."""
+    acc = BuildAccumulator(c)
+    acc.raw_rows = data["raw_rows"]
+    for k, v in data["loan_level"]:
+        v["first_source_row"] = row_map[v["first_source_row"]]
+        acc.loan_level[tuple(k)] = LoanRecord.from_dict(v)
+    for k, v in data["event_monthly"]:
+        acc.event_monthly[tuple(k)].update(v)
+    for k, v in data["hc_monthly"]:
+        acc.hc_monthly[tuple(k)] = v
+    for d in data["dq_issues"]:
+        d["source_row"] = row_map[d["source_row"]]
+        acc.dq_issues.append(d)
+    return acc
+
+
+def load_state(state_dir: Path):
+    path = state_dir / "state.json"
+    if not path.exists():
+        return None
+    state = json.loads(path.read_text(encoding="utf-8"))
+    if state.get("version") != STATE_VERSION:
+        return None
+    return state
+
+
+def read_source_incremental(source: Path, state_dir: Path, prior):
+    """Stream the sheet, re-aggregating only report months whose rows changed.
+
+    Returns ``(acc, state, dirty, stats)``: the merged accumulator, the new state
+    index, the partition files ``save_state`` must write, and the reused/rebuilt months.
+    """
+    base = cache_counts()
+    with open_source_rows(source) as it:
+        headers = next(it)
+        c = resolve_columns(headers)
+        header_hash = hashlib.sha1("\x1f".join(headers).encode("utf-8")).hexdigest()
+        prior_months = (prior or {}).get("months", {})
+        if not prior or prior.get("header_hash") != header_hash:
+            prior_months = {}
+
+        hashes = {}
+        rows_by_month = defaultdict(list)
+        parts = {}
+        parked = {}
+        reused = []
+        bom_idx = c["bom"]
+        try:
+            for source_row, row in enumerate(it, start=2):
+                bom = (cached_date(row[bom_idx]) if bom_idx is not None else None) or "unknown"
+                h = hashes.get(bom)
+                if h is None:
+                    h = hashes[bom] = hashlib.sha1()
+                h.update(("\x1f".join(row) + "\x1e").encode("utf-8"))
+                rows_by_month[bom].append(source_row)
+                if bom in prior_months:
+                    fh = parked.get(bom)
+                    if fh is None:
+                        fh = parked[bom] = tempfile.TemporaryFile()
+                    pickle.dump((source_row, row), fh, pickle.HIGHEST_PROTOCOL)
+                else:
+                    part = parts.get(bom)
+                    if part is None:
+                        part = parts[bom] = BuildAccumulator(c)
+                    part.add_row(row, source_row)
+
+            for bom, fh in parked.items():
+                meta = prior_months[bom]
+                if meta["hash"] == hashes[bom].hexdigest():
+                    data = json.loads((state_dir / meta["file"]).read_text(encoding="utf-8"))
+                    row_map = dict(zip(expand_runs(data["rows"]), rows_by_month[bom]))
+                    parts[bom] = partition_from_json(data, c, row_map)
+                    reused.append(bom)
+                    continue
+                part = parts[bom] = BuildAccumulator(c)
+                fh.seek(0)
+                while True:
+                    try:
+                        source_row, row = pickle.load(fh)
+                    except EOFError:
+                        break
+                    part.add_row(row, source_row)
+        finally:
+            for fh in parked.values():
+                fh.close()
+
+    rebuilt = sorted(b for b in parts if b not in reused)
+    months = {}
+    dirty = {}
+    for bom in sorted(parts):
+        digest = hashes[bom].hexdigest()
+        if bom in rebuilt:
+            fname = f"month_{re.sub(r'[^0-9A-Za-z_-]+', '_', bom)}_{digest[:12]}.json"
+            dirty[fname] = partition_to_json(parts[bom], rows_by_month[bom])
+        else:
+            fname = prior_months[bom]["file"]
+        months[bom] = {"hash": digest, "file": fname}
+
+    acc = merge_partitions(parts[b] for b in sorted(parts))
+    acc.cache_counts = cache_counts_since(base)
+    stats = {"reused_months": sorted(reused), "rebuilt_months": rebuilt}
+    return acc, {"header_hash": header_hash, "months": months}, dirty, stats
+
+
+def save_state(state_dir: Path, source_hash, state, dirty):
+    state_dir.mkdir(parents=True, exist_ok=True)
+    for fname, data in dirty.items():
+        (state_dir / fname).write_text(json.dumps(data), encoding="utf-8")
+    tmp = state_dir / "state.json.tmp"
+    tmp.write_text(json.dumps({"version": STATE_VERSION, "source_sha1": source_hash, **state}), encoding="utf-8")
+    tmp.replace(state_dir / "state.json")
+    live = {m["file"] for m in state["months"].values()}
+    for p in state_dir.glob("month_*.json"):
+        if p.name not in live:
+            p.unlink()
+
+
+# Query service (`serve` subcommand). Loads the three CSV outputs once into row lists
+# with per-column value -> row-position indexes, answers filter/aggregate queries over
+# plain asyncio streams, and swaps in a freshly loaded snapshot whenever
+# MANIFEST_FILE changes (it is published after every output file). A snapshot is only
+# accepted when every file it read matches the manifest's sha1 and the manifest did not
+# change while loading, so it never mixes two builds.
+SERVE_TABLES = {"kpi": "vp_kpi_monthly", "loans": "vp_loan_detail", "exceptions": "vp_exception_log"}
+# query parameter -> column; only columns a table has are indexed and filterable
+SERVE_FILTERS = {"vp": "vp", "month": "report_month", "state": "state", "product": "product_bucket_group"}
+SERVE_DEFAULT_LIMIT = 1000
+LATENCY_WINDOW = 2048
+
+
+def parse_csv_value(h, v):
+    if v == "":
+        return None
+    if h in INT_COLUMNS:
+        return int(v)
+    if h in DATE_COLUMNS or h in TEXT_COLUMNS:
+        return v
+    return float(v)
+
+
+def load_serving_snapshot(outdir: Path):
+    """Typed rows and filter indexes for each table, tagged with the build it came from.
+
+    Each file is hashed from the same bytes it is parsed from and checked against
+    MANIFEST_FILE, and the manifest is stat'ed before and after; a ValueError means a
+    build was publishing meanwhile and the caller should try again later.
+    """
+    manifest_path = outdir / MANIFEST_FILE
+    manifest_mtime = manifest_path.stat().st_mtime_ns
+    files = json.loads(manifest_path.read_text(encoding="utf-8"))["files"]
+
+    def verified_text(name):
+        data = (outdir / name).read_bytes()
+        if hashlib.sha1(data).hexdigest() != files[name]["sha1"]:
+            raise ValueError(f"{name} does not match {MANIFEST_FILE}")
+        return data.decode("utf-8")
+
+    summary = json.loads(verified_text("build_summary.json"))
+    tables = {}
+    for key, name in SERVE_TABLES.items():
+        reader = csv.reader(io.StringIO(verified_text(f"{name}.csv"), newline=""))
+        headers = next(reader)
+        rows = [{h: parse_csv_value(h, v) for h, v in zip(headers, rec)} for rec in reader]
+        indexes = {}
+        for param, col in SERVE_FILTERS.items():
+            if col in headers:
+                index = defaultdict(list)
+                for i, r in enumerate(rows):
+                    index[r[col]].append(i)
+                indexes[param] = dict(index)
+        numeric = [h for h in headers if h not in TEXT_COLUMNS and h not in DATE_COLUMNS]
+        tables[key] = {"headers": headers, "rows": rows, "indexes": indexes, "numeric": numeric}
+    if manifest_path.stat().st_mtime_ns != manifest_mtime:
+        raise ValueError(f"{MANIFEST_FILE} changed while loading")
+    return {
+        "tables": tables,
+        "fingerprint": summary.get("run_fingerprint"),
+        "generated_at": summary.get("generated_at"),
+        "manifest_mtime": manifest_mtime,
+        "loaded_at": dt.datetime.now().replace(microsecond=0).isoformat(sep=" "),
+    }
+
+
+def select_rows(table, params):
+    """Rows matching every filter in ``params``, in table order."""
+    filters = {p: v for p, v in params.items() if p in SERVE_FILTERS}
+    unknown = [p for p in filters if p not in table["indexes"]]
+    if unknown:
+        raise ValueError(f"cannot filter this table by {', '.join(unknown)}")
+    if not filters:
+        return table["rows"]
+    # walk the smallest index list and check the remaining filters on the rows
+    lists = sorted((table["indexes"][p].get(v, []), SERVE_FILTERS[p], v) for p, v in filters.items())
+    positions, _, _ = lists[0]
+    rest = [(col, v) for _, col, v in lists[1:]]
+    rows = table["rows"]
+    return [rows[i] for i in positions if all(rows[i][col] == v for col, v in rest)]
+
+
+def aggregate_rows(table, rows, by):
+    """Row count and sums of the numeric columns, grouped by the ``by`` filter names."""
+    cols = [SERVE_FILTERS.get(b, b) for b in by]
+    missing = [c for c in cols if c not in table["headers"]]
+    if missing:
+        raise ValueError(f"cannot group this table by {', '.join(missing)}")
+    groups = {}
+    for r in rows:
+        key = tuple(r[c] for c in cols)
+        g = groups.get(key)
+        if g is None:
+            g = groups[key] = {**dict(zip(cols, key)), "rows": 0}
+            g.update((h, 0 if h in INT_COLUMNS else 0.0) for h in table["numeric"])
+        g["rows"] += 1
+        for h in table["numeric"]:
+            g[h] += r[h] or 0
+    return [groups[k] for k in sorted(groups, key=lambda k: tuple((v is None, v or "") for v in k))]
+
+
+def latency_stats(samples):
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 3)
+
+    return {"p50_ms": pct(0.50), "p95_ms": pct(0.95), "p99_ms": pct(0.99), "max_ms": round(ordered[-1] * 1000, 3)}
+
+
+class KpiService:
+    """HTTP handlers over the current snapshot plus reload and latency bookkeeping."""
+
+    def __init__(self, outdir: Path, poll_seconds):
+        self.outdir = outdir
+        self.poll_seconds = poll_seconds
+        self.snapshot = load_serving_snapshot(outdir)
+        self.reloads = 0
+        self.reload_errors = 0
+        self.requests = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.latency = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+
+    async def watch(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.poll_seconds)
+            try:
+                mtime = (self.outdir / MANIFEST_FILE).stat().st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if mtime == self.snapshot["manifest_mtime"]:
+                continue
+            try:
+                snapshot = await loop.run_in_executor(None, load_serving_snapshot, self.outdir)
+            except (OSError, ValueError, KeyError, StopIteration) as e:  # build still publishing
+                self.reload_errors += 1
+                print(f"reload skipped: {e}", flush=True)
+                continue
+            self.snapshot = snapshot  # single assignment: requests see the old or the new build
+            self.reloads += 1
+            print(f"reloaded build {snapshot['fingerprint']} ({snapshot['generated_at']})", flush=True)
+
+    def route(self, path, params):
+        snap = self.snapshot
+        if path == "/health":
+            return {"status": "ok", "fingerprint": snap["fingerprint"], "generated_at": snap["generated_at"]}
+        if path == "/metrics":
+            return {
+                "fingerprint": snap["fingerprint"],
+                "loaded_at": snap["loaded_at"],
+                "reloads": self.reloads,
+                "reload_errors": self.reload_errors,
+                "endpoints": {
+                    p: {"requests": self.requests[p], "errors": self.errors[p], **latency_stats(self.latency[p])}
+                    for p in sorted(self.requests)
+                },
+            }
+        parts = path.strip("/").split("/")
+        table = snap["tables"].get(parts[0])
+        if table is None or len(parts) > 2 or (len(parts) == 2 and parts[1] != "aggregate"):
+            raise LookupError(path)
+        rows = select_rows(table, params)
+        if len(parts) == 2:
+            by = [b for b in params.get("by", "").split(",") if b]
+            groups = aggregate_rows(table, rows, by)
+            return {"fingerprint": snap["fingerprint"], "count": len(groups), "groups": groups}
+        offset = int(params.get("offset", 0))
+        limit = int(params.get("limit", SERVE_DEFAULT_LIMIT))
+        return {"fingerprint": snap["fingerprint"], "count": len(rows), "rows": rows[offset : offset + limit]}
+
+    async def handle(self, reader, writer):
+        try:
+            request = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass  # headers are not needed
+            started = time.perf_counter()
+            method, _, target = request.decode("latin-1").partition(" ")
+            split = urllib.parse.urlsplit(target.rsplit(" ", 1)[0])
+            path = split.path.rstrip("/") or "/"
+            params = dict(urllib.parse.parse_qsl(split.query))
+            status = "200 OK"
+            try:
+                if method != "GET":
+                    status, body = "405 Method Not Allowed", {"error": "GET only"}
+                else:
+                    body = self.route(path, params)
+            except LookupError:
+                status, body = "404 Not Found", {"error": f"unknown path {path}"}
+            except ValueError as e:
+                status, body = "400 Bad Request", {"error": str(e)}
+            payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: application/json; charset=utf-8\r\n"
+                f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode("latin-1")
+                + payload
             )
-        ).hexdigest(),
+            await writer.drain()
+            key = "(not found)" if status.startswith("404") else path
+            self.requests[key] += 1
+            if not status.startswith("200"):
+                self.errors[key] += 1
+            self.latency[key].append(time.perf_counter() - started)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+async def serve(outdir: Path, host, port, poll_seconds):
+    service = KpiService(outdir, poll_seconds)
+    server = await asyncio.start_server(service.handle, host, port)
+    loans = len(service.snapshot["tables"]["loans"]["rows"])
+    print(f"Serving {outdir} ({loans:,} loan rows) on http://{host}:{port}", flush=True)
+    watcher = asyncio.create_task(service.watch())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        watcher.cancel()
+
+
+def serve_main(argv):
+    parser = argparse.ArgumentParser(
+        prog="build_vp_dashboard_data.py serve", description="Serve KPI queries over the build outputs."
+    )
+    parser.add_argument("--outdir", type=str, default="output/tableau_ready", help="Build output directory.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Bind address. Default: 127.0.0.1.")
+    parser.add_argument("--port", type=int, default=8765, help="Port. Default: 8765.")
+    parser.add_argument(
+        "--poll", type=float, default=2.0, help="Seconds between build_summary.json checks. Default: 2."
+    )
+    args = parser.parse_args(argv)
+    outdir = (Path(__file__).resolve().parents[1] / args.outdir).resolve()
+    if not (outdir / "build_summary.json").exists():
+        raise SystemExit(f"No build_summary.json in {outdir}; run a csv build first.")
+    try:
+        asyncio.run(serve(outdir, args.host, args.port, args.poll))
+    except KeyboardInterrupt:
+        pass
+
+
+# Watch mode (--watch DIR). The directory is polled for sources; a change only
+# triggers a build once nothing has changed for --settle seconds (partial copies keep
+# growing, bursts of saves keep resetting the clock) and, for a workbook, the newest
+# file opens as a zip. Delimited files have no such check and rely on --settle. Builds are --incremental, so after the first one only changed report months
+# are re-aggregated, and the converter caches stay warm in the long-running process.
+WATCH_POLL_SECONDS = 1.0
+WATCH_SETTLE_SECONDS = 5.0
+
+
+def scan_sources(directory: Path):
+    """``{path: (size, mtime_ns)}`` of candidate sources (the .xlsx/.csv/.tsv(.gz) files
+    --source accepts); skips preliminary files and Excel lock files."""
+    found = {}
+    for p in directory.iterdir():
+        n = p.name.lower()
+        if "preliminary" in n or n.startswith("~$"):
+            continue
+        if p.suffix.lower() != ".xlsx" and source_delimiter(p) is None:
+            continue
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            continue
+        found[p] = (st.st_size, st.st_mtime_ns)
+    return found
+
+
+def watch(args, directory: Path, outdir: Path):
+    if not directory.is_dir():
+        raise SystemExit(f"--watch needs a directory: {directory}")
+    outdir.mkdir(parents=True, exist_ok=True)
+    log_path = outdir / "watch_log.jsonl"
+    print(f"Watching {directory} (settle {args.settle:g}s); builds logged to {log_path}", flush=True)
+    built = None
+    last = None
+    changed_at = time.monotonic()
+    while True:
+        current = scan_sources(directory)
+        if current != last:
+            last, changed_at = current, time.monotonic()
+        if current and current != built and time.monotonic() - changed_at >= args.settle:
+            source = max(current, key=lambda p: current[p][1])
+            if source.suffix.lower() == ".xlsx" and not zipfile.is_zipfile(source):
+                changed_at = time.monotonic()  # still being written; wait for it to settle again
+            else:
+                started = time.perf_counter()
+                entry = {"at": dt.datetime.now().replace(microsecond=0).isoformat(sep=" "), "source": str(source)}
+                try:
+                    summary = run_build(args, outdir, [source])
+                except (Exception, SystemExit) as e:
+                    entry["error"] = f"{type(e).__name__}: {e}"
+                    summary = None
+                entry["wall_seconds"] = round(time.perf_counter() - started, 3)
+                if summary is not None:
+                    entry["raw_rows_read"] = summary["raw_rows_read"]
+                    entry["stages"] = {k: v["wall_seconds"] for k, v in summary["stages"].items()}
+                    entry["incremental"] = summary.get("incremental")
+                    detail = ", ".join(f"{k} {v:.2f}s" for k, v in entry["stages"].items())
+                    months = entry["incremental"] or {}
+                    print(
+                        f"[{entry['at']}] built {source.name} in {entry['wall_seconds']:.2f}s ({detail}; "
+                        f"{len(months.get('rebuilt_months', []))} months rebuilt, "
+                        f"{len(months.get('reused_months', []))} reused)",
+                        flush=True,
+                    )
+                elif "error" in entry:
+                    print(f"[{entry['at']}] build of {source.name} failed: {entry['error']}", flush=True)
+                else:
+                    entry["unchanged"] = True
+                with log_path.open("a", encoding="utf-8") as fh:
+                    fh.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                built = current
+        time.sleep(WATCH_POLL_SECONDS)
+
+
+def output_options(args):
+    """Options that decide which files a build publishes; an --incremental run with the
+    same source only skips the build when these match the last build's summary."""
+    return {
+        "formats": sorted(args.format),
+        "rollup": args.rollup,
+        "trailing": args.trailing,
+        "leaderboard": args.leaderboard,
+        "delta": args.delta,
+        "dq_detail": args.dq_detail,
     }
-    (outdir / "build_summary.json").write_text(json.dumps(summary, indent=2, ensure_ascii=False), encoding="utf-8")
 
+
+def validate_options(args, sources):
+    if args.incremental and len(sources) > 1:
+        raise SystemExit("--incremental supports a single --source workbook.")
+    if args.shards and (args.incremental or len(sources) > 1):
+        raise SystemExit("--shards applies to a single --source workbook without --incremental.")
+    if args.shards and source_delimiter(sources[0]) is not None:
+        raise SystemExit("--shards splits xlsx sheets; delimited sources are already read as a plain stream.")
+    if args.max_memory and (args.incremental or args.shards or len(sources) > 1):
+        raise SystemExit("--max-memory applies to a single --source workbook.")
+    if args.engine == "numpy":
+        if args.incremental or args.shards or args.max_memory or len(sources) > 1:
+            raise SystemExit("--engine numpy reads a single --source without --incremental, --shards or --max-memory.")
+        require_numpy()
+    if args.sample is not None or args.sample_loans is not None:
+        if args.sample is not None and args.sample_loans is not None:
+            raise SystemExit("Use one of --sample or --sample-loans.")
+        if args.sample is not None and not 0 < args.sample <= 1:
+            raise SystemExit("--sample takes a fraction in (0, 1].")
+        if args.sample_loans is not None and args.sample_loans < 1:
+            raise SystemExit("--sample-loans takes a positive number of loan keys.")
+        if args.incremental or args.shards or args.max_memory or args.engine != "python" or len(sources) > 1:
+            raise SystemExit("--sample/--sample-loans preview a single --source with the default reader only.")
+        if args.archive:
+            raise SystemExit("--archive keeps full builds; drop it for --sample/--sample-loans previews.")
+    elif args.sample_scale:
+        raise SystemExit("--sample-scale goes with --sample or --sample-loans.")
+    if args.leaderboard is not None and args.leaderboard < 1:
+        raise SystemExit("--leaderboard takes a positive list size.")
+    if args.dq_detail and args.dq_log != "aggregate":
+        raise SystemExit("--dq-detail goes with --dq-log aggregate; the default log already has one row per issue.")
+    if "parquet" in args.format:
+        require_pyarrow()
+
+
+def run_build(args, outdir: Path, sources):
+    """One build into ``outdir``; returns the summary, or None when --incremental found nothing to do."""
+    source = sources[0]
+    sampled = args.sample is not None or args.sample_loans is not None
+    outdir.mkdir(parents=True, exist_ok=True)
+    state_dir = outdir / ".build_state"
+    profiler = None
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    side = ([DQ_DETAIL_TABLE] if args.dq_detail else []) + (delta_table_names() if args.delta else [])
+    optional = [(ROLLUP_TABLE, args.rollup), (LEADERBOARD_TABLE, args.leaderboard), (TRAILING_TABLE, args.trailing)]
+    table_names = TABLE_NAMES + [t for t, on in optional if on]
+    stages = {}
+    with timed(stages, "rules") as st:
+        rules = load_rules(Path(args.rules)) if args.rules else DEFAULT_RULES
+        plan = compile_rules(rules)
+    st["rules"] = len(plan)
+    rules_sha1 = rules_fingerprint(rules)
+    with timed(stages, "fingerprint"):
+        if len(sources) == 1:
+            source_hash = file_sha1(source)
+        else:
+            source_hash = hashlib.sha1("|".join(file_sha1(p) for p in sources).encode("utf-8")).hexdigest()
+
+    incremental = None
+    if args.incremental:
+        prior = load_state(state_dir)
+        summary_path = outdir / "build_summary.json"
+        last = json.loads(summary_path.read_text(encoding="utf-8")) if summary_path.exists() else {}
+        if (
+            prior
+            and prior.get("source_sha1") == source_hash
+            and last.get("dq_log", "rows") == args.dq_log
+            and last.get("output_options") == output_options(args)
+            and last.get("rules", {}).get("fingerprint") == rules_sha1
+            and (not args.archive or (Path(args.archive) / ARCHIVE_INDEX).exists())
+            and all(p.exists() for p in output_paths(outdir, args.format, side, table_names))
+        ):
+            print(f"No changes in {source.name}; outputs are up to date.")
+            if profiler is not None:
+                profiler.disable()
+            return None
+    with timed(stages, "read") as st:
+        if args.incremental:
+            acc, state, dirty, incremental = read_source_incremental(source, state_dir, prior)
+        elif args.shards and args.shards > 1:
+            acc = read_source_sharded(source, args.shards, args.workers)
+        elif args.max_memory:
+            acc = read_source_spilling(source, args.max_memory)
+        elif sampled:
+            acc = read_source_sampled(source, args.sample, args.sample_loans)
+        elif args.engine == "numpy":
+            acc = read_source_numpy(source)
+        else:
+            acc = read_sources(sources, args.workers)
+    st["rows"] = acc.raw_rows
+    if acc.timings:
+        st["breakdown_seconds"] = {k: round(v, 4) for k, v in acc.timings.items()}
+
+    with timed(stages, "build_tables", acc.raw_rows):
+        scale = acc.sample["scale"] if args.sample_scale else 1.0
+        monthly_rows, loan_rows, exception_rows, rollup_rows, board = build_tables(
+            acc, args.dq_log, args.rollup, plan, scale, args.leaderboard
+        )
+
+    tables = [
+        ("vp_kpi_monthly", monthly_rows, KPI_HEADERS + RANK_HEADERS if args.leaderboard else KPI_HEADERS),
+        ("vp_loan_detail", loan_rows, LOAN_HEADERS),
+        (
+            "vp_exception_log",
+            exception_rows,
+            EXCEPTION_HEADERS + DQ_AGGREGATE_HEADERS if args.dq_log == "aggregate" else EXCEPTION_HEADERS,
+        ),
+    ]
+    if args.rollup:
+        tables.append((ROLLUP_TABLE, rollup_rows, ROLLUP_HEADERS))
+    if args.leaderboard:
+        tables.append((LEADERBOARD_TABLE, board, LEADERBOARD_HEADERS))
+    if args.trailing:
+        with timed(stages, "trailing", len(monthly_rows)):
+            tables.append((TRAILING_TABLE, trailing_kpis(monthly_rows), TRAILING_HEADERS))
+    side_tables = []
+    if args.dq_detail:
+        issues = acc.dq_issues
+        detail_rows = LazyRows(lambda: map(dq_detail_row, issues), len(issues))
+        side_tables.append((DQ_DETAIL_TABLE, detail_rows, DQ_DETAIL_HEADERS))
+    if args.delta:
+        with timed(stages, "delta", acc.raw_rows):
+            delta_tables, delta = build_deltas(outdir, tables)
+        side_tables += delta_tables
+    source_file = str(source) if len(sources) == 1 else [str(p) for p in sources]
+    staging = Path(tempfile.mkdtemp(prefix=".staging-", dir=outdir))
+    try:
+        # cProfile only sees the thread that enabled it, so profiled runs write serially
+        write_outputs(staging, tables, args.format, stages, side_tables, serial=profiler is not None)
+        names = [p.name for p in output_paths(outdir, args.format, side, table_names)]
+        with timed(stages, "checksum"):
+            files = output_manifest(staging, names)
+        if args.archive:
+            with timed(stages, "archive", len(monthly_rows) + len(loan_rows)):
+                archived = archive_tables(Path(args.archive), staging, tables, source_hash, source_file)
+
+        summary = {
+            "source_file": source_file,
+            "generated_at": dt.datetime.now().replace(microsecond=0).isoformat(sep=" "),
+            "raw_rows_read": acc.raw_rows,
+            "vp_month_rows": len(monthly_rows),
+            "loan_detail_rows": len(loan_rows),
+            "exception_rows": len(exception_rows),
+            "output_files": [str(p) for p in output_paths(outdir, args.format, side, table_names)],
+            "run_fingerprint": source_hash,
+            "coercion_cache": cache_hit_rates(add_cache_counts({}, acc.cache_counts)),
+            "dq_log": args.dq_log,
+            "output_options": output_options(args),
+            "dq_issue_rows": len(acc.dq_issues),
+            "rules": {"source": args.rules, "fingerprint": rules_sha1, "hits": rule_stats(plan)},
+        }
+        if args.rollup:
+            summary["rollup_rows"] = len(rollup_rows)
+        if args.leaderboard:
+            summary["leaderboard_rows"] = len(board)
+        if sampled:
+            summary["sample"] = {**acc.sample, "scaled": args.sample_scale}
+        if args.archive:
+            summary["archive"] = archived
+        if args.delta:
+            summary["delta"] = delta
+        if incremental is not None:
+            summary["incremental"] = incremental
+        if args.max_memory:
+            summary["spill"] = acc.spill
+        summary["peak_rss_bytes"] = peak_rss_bytes()
+        summary["stages"] = stages
+        if profiler is not None:
+            profiler.disable()
+            profile_path = outdir / args.profile
+            profiler.dump_stats(profile_path)
+            summary["profile"] = str(profile_path)
+        (staging / "build_summary.json").write_text(json.dumps(summary, indent=2, ensure_ascii=False), encoding="utf-8")
+        files.update(output_manifest(staging, ["build_summary.json"]))
+        manifest = {"run_fingerprint": source_hash, "generated_at": summary["generated_at"], "files": files}
+        (staging / MANIFEST_FILE).write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+        publish_outputs(staging, outdir, [*names, "build_summary.json", MANIFEST_FILE])
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+    if incremental is not None:
+        # written last so an interrupted run is never mistaken for an up-to-date one
+        save_state(state_dir, source_hash, state, dirty)
+    return summary
+
+
+def main():
+    if sys.argv[1:2] == ["serve"]:
+        return serve_main(sys.argv[2:])
+    if sys.argv[1:2] == ["archive"]:
+        return archive_main(sys.argv[2:])
+    parser = argparse.ArgumentParser(description="Build Tableau-ready VP dashboard datasets from raw Excel.")
+    parser.add_argument(
+        "--source",
+        type=str,
+        nargs="+",
+        help="Source xlsx/csv/tsv/csv.gz path(s) or glob(s); several are merged. Default: newest xlsx in repo root.",
+    )
+    parser.add_argument("--outdir", type=str, default="output/tableau_ready", help="Output directory.")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Reuse per-month aggregates from the previous --incremental run; only changed report months are rebuilt.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Worker processes for multi-workbook or sharded builds. Default: CPU count.",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=None,
+        help="Split a single large sheet into this many row ranges and parse them in parallel.",
+    )
+    parser.add_argument(
+        "--format",
+        type=parse_formats,
+        default=["csv", "xlsx"],
+        help=f"Comma-separated output formats from {','.join(OUTPUT_FORMATS)}. Default: csv,xlsx.",
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=parse_size,
+        default=None,
+        help="Budget for the loan dedupe state, e.g. 512M or 2G; past it the state spills to sorted runs on disk.",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["python", "numpy"],
+        default="python",
+        help="Dedupe and group sums row by row (default) or column-wise in NumPy batches (needs numpy).",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="build_profile.pstats",
+        default=None,
+        help="Dump a cProfile/pstats file for the run (relative paths are under --outdir).",
+    )
+    parser.add_argument(
+        "--rollup",
+        action="store_true",
+        help=f"Also write {ROLLUP_TABLE}: loan totals by month, VP, state, product and purpose with subtotals.",
+    )
+    parser.add_argument(
+        "--leaderboard",
+        type=int,
+        nargs="?",
+        const=LEADERBOARD_SIZE,
+        default=None,
+        metavar="N",
+        help=f"Add per-month rank/percentile columns to vp_kpi_monthly and write the top/bottom N VPs "
+        f"(default {LEADERBOARD_SIZE}) per metric to {LEADERBOARD_TABLE}.",
+    )
+    parser.add_argument(
+        "--trailing",
+        action="store_true",
+        help=f"Also write {TRAILING_TABLE}: trailing 3/6/12-month and MoM/YoY KPIs per VP.",
+    )
+    parser.add_argument(
+        "--rules",
+        type=str,
+        help="JSON file of exception rules (a list, or {\"rules\": [...]}) replacing the built-in ones.",
+    )
+    parser.add_argument(
+        "--sample",
+        type=float,
+        default=None,
+        metavar="FRACTION",
+        help="Preview build from a deterministic hash sample of this share of loan keys and event rows.",
+    )
+    parser.add_argument(
+        "--sample-loans",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Preview build from a deterministic hash sample of N loan keys (events sampled at the same share).",
+    )
+    parser.add_argument(
+        "--sample-scale",
+        action="store_true",
+        help="With --sample/--sample-loans, scale vp_kpi_monthly totals up by the inverse of the sampled share.",
+    )
+    parser.add_argument(
+        "--preview-dir",
+        type=str,
+        default=None,
+        help="Output directory for --sample/--sample-loans builds. Default: <outdir>/preview.",
+    )
+    parser.add_argument(
+        "--archive",
+        type=str,
+        default=None,
+        metavar="DIR",
+        help="Also upsert this build's report months into a month-partitioned archive (e.g. output/archive).",
+    )
+    parser.add_argument(
+        "--delta",
+        action="store_true",
+        help="Also write row hashes and inserted/updated/deleted KPI and loan rows against the last --delta build.",
+    )
+    parser.add_argument(
+        "--dq-log",
+        choices=["rows", "aggregate"],
+        default="rows",
+        help="Dedupe conflicts in vp_exception_log: one row each (default) or one per loan key and issue type.",
+    )
+    parser.add_argument(
+        "--dq-detail",
+        action="store_true",
+        help=f"With --dq-log aggregate, also write every conflict to {DQ_DETAIL_TABLE}.csv.",
+    )
+    parser.add_argument(
+        "--watch",
+        type=str,
+        default=None,
+        metavar="DIR",
+        help="Keep running and rebuild (incrementally) from the newest xlsx/csv/tsv(.gz) source in DIR whenever it changes.",
+    )
+    parser.add_argument(
+        "--settle",
+        type=float,
+        default=WATCH_SETTLE_SECONDS,
+        help=f"--watch: seconds a change must stay quiet before building. Default: {WATCH_SETTLE_SECONDS:g}.",
+    )
+    args = parser.parse_args()
+
+    root = Path(__file__).resolve().parents[1]
+    outdir = (root / args.outdir).resolve()
+    if args.sample is not None or args.sample_loans is not None:
+        outdir = (root / args.preview_dir).resolve() if args.preview_dir else outdir / "preview"
+    if args.archive:
+        args.archive = str((root / args.archive).resolve())
+    if args.watch:
+        if args.source:
+            raise SystemExit("--watch picks its own source; drop --source.")
+        args.incremental = True
+        validate_options(args, [None])
+        return watch(args, Path(args.watch).resolve(), outdir)
+    sources = expand_sources(args.source) if args.source else [p for p in [detect_source_file(root)] if p]
+    if not sources or not all(p.exists() for p in sources):
+        raise SystemExit("No source found. Provide --source /path/to/file.xlsx (or .csv, .tsv, .csv.gz)")
+    validate_options(args, sources)
+    summary = run_build(args, outdir, sources)
+    if summary is None:
+        summary = json.loads((outdir / "build_summary.json").read_text(encoding="utf-8"))
     print(json.dumps(summary, indent=2, ensure_ascii=False))
 
 
 if __name__ == "__main__":
     main()
-
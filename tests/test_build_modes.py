@@ -0,0 +1,107 @@
+"""Every read mode must publish the same tables as the plain build.
+
+Runs the build script on a small workbook from the benchmark generator and compares
+the CSV outputs byte for byte. Run with ``python -m pytest tests``.
+"""
+from __future__ import annotations
+
+import csv
+import importlib.util
+import json
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+BUILD_SCRIPT = ROOT / "scripts" / "build_vp_dashboard_data.py"
+ROWS = 10000
+TABLES = ["vp_kpi_monthly", "vp_loan_detail", "vp_exception_log"]
+
+
+def load_script(name):
+    spec = importlib.util.spec_from_file_location(name, ROOT / "scripts" / f"{name}.py")
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
+
+
+bench = load_script("benchmark_vp_dashboard_build")
+
+
+def build(outdir: Path, *sources, args=()):
+    subprocess.run(
+        [sys.executable, str(BUILD_SCRIPT), "--source", *map(str, sources), "--outdir", str(outdir), "--format", "csv", *args],
+        check=True,
+        stdout=subprocess.DEVNULL,
+    )
+    return outdir
+
+
+class BuildModesTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.dir = Path(cls.tmp.name)
+        cls.workbook = bench.synthetic_workbook(cls.dir, ROWS, seed=7)
+        cls.plain = build(cls.dir / "plain", cls.workbook)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp.cleanup()
+
+    def assertSameTables(self, expected: Path, actual: Path):
+        for t in TABLES:
+            with self.subTest(table=t):
+                self.assertEqual((expected / f"{t}.csv").read_bytes(), (actual / f"{t}.csv").read_bytes())
+
+    def test_shards(self):
+        self.assertSameTables(self.plain, build(self.dir / "shards", self.workbook, args=["--shards", "3"]))
+
+    def test_max_memory_spill(self):
+        out = build(self.dir / "spill", self.workbook, args=["--max-memory", "100K"])
+        self.assertGreater(json.loads((out / "build_summary.json").read_text())["spill"]["key_runs"], 0)
+        self.assertSameTables(self.plain, out)
+
+    def test_delimited_sources(self):
+        for suffix in ("csv", "csv.gz", "tsv"):
+            with self.subTest(suffix=suffix):
+                source = bench.synthetic_delimited(self.workbook, suffix)
+                self.assertSameTables(self.plain, build(self.dir / suffix, source))
+
+    @unittest.skipUnless(importlib.util.find_spec("numpy"), "numpy is not installed")
+    def test_numpy_engine(self):
+        for source in (self.workbook, bench.synthetic_delimited(self.workbook, "csv")):
+            with self.subTest(source=source.name):
+                self.assertSameTables(self.plain, build(self.dir / f"numpy_{source.suffix[1:]}", source, args=["--engine", "numpy"]))
+
+    def test_sample_everything(self):
+        out = build(self.dir / "sample", self.workbook, args=["--sample", "1.0"])
+        self.assertSameTables(self.plain, out / "preview")
+
+    def test_incremental(self):
+        source = bench.synthetic_delimited(self.workbook, "csv")
+        with source.open(newline="", encoding="utf-8") as fh:
+            rows = list(csv.reader(fh))
+        header, body = rows[0], rows[1:-10]
+        bom, amount = header.index("BOM"), len(header) - 1
+        first_month = min(r[bom] for r in body)
+        for r in body:
+            if r[bom] == first_month:
+                r[amount] = "123.45"
+        changed = self.dir / "changed.csv"
+        with changed.open("w", newline="", encoding="utf-8") as fh:
+            csv.writer(fh).writerows([header, *body])
+
+        out = self.dir / "incremental"
+        build(out, source, args=["--incremental"])
+        self.assertSameTables(self.plain, out)
+        build(out, changed, args=["--incremental"])
+        summary = json.loads((out / "build_summary.json").read_text())
+        self.assertTrue(summary["incremental"]["reused_months"])
+        self.assertSameTables(build(self.dir / "changed", changed), out)
+
+
+if __name__ == "__main__":
+    unittest.main()
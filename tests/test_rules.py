@@ -0,0 +1,61 @@
+"""Malformed --rules files must fail through compile_rules' SystemExit, never a traceback."""
+from __future__ import annotations
+
+import importlib.util
+import json
+import tempfile
+import unittest
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+spec = importlib.util.spec_from_file_location("build_vp_dashboard_data", ROOT / "scripts" / "build_vp_dashboard_data.py")
+build = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(build)
+
+VALID = {"name": "mom_drop", "type": "change", "column": "total_revenue", "op": "<", "value": -0.5}
+
+
+class RulesValidationTest(unittest.TestCase):
+    def load(self, data):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / "rules.json"
+            path.write_text(json.dumps(data), encoding="utf-8")
+            return build.compile_rules(build.load_rules(path))
+
+    def assertRejected(self, data, message):
+        with self.assertRaises(SystemExit) as cm:
+            self.load(data)
+        self.assertIn(message, str(cm.exception))
+
+    def test_accepts_list_and_rules_object(self):
+        self.assertEqual([p["name"] for p in self.load([VALID])], ["mom_drop"])
+        self.assertEqual([p["name"] for p in self.load({"rules": [VALID]})], ["mom_drop"])
+
+    def test_top_level_object_without_rules(self):
+        self.assertRejected({"foo": 1}, "must be a list of rules")
+
+    def test_top_level_scalar(self):
+        self.assertRejected("mom_drop", "must be a list of rules")
+
+    def test_rules_not_a_list(self):
+        self.assertRejected({"rules": VALID}, "must be a list of rules")
+
+    def test_rule_not_an_object(self):
+        self.assertRejected([1], "Exception rule 1: must be an object")
+        self.assertRejected([["mom_drop"]], "must be an object")
+
+    def test_name_not_a_string(self):
+        self.assertRejected([{**VALID, "name": 5}], "needs a name without commas")
+
+    def test_table_and_column_not_strings(self):
+        self.assertRejected([{**VALID, "table": ["monthly"]}], "table must be one of")
+        self.assertRejected([{**VALID, "column": ["total_revenue"]}], "unknown monthly column")
+
+    def test_relative_not_a_bool(self):
+        for relative in ("false", 0, None):
+            with self.subTest(relative=relative):
+                self.assertRejected([{**VALID, "relative": relative}], "relative must be true or false")
+
+
+if __name__ == "__main__":
+    unittest.main()